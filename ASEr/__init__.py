@@ -16,5 +16,9 @@ Get ASE counts from BAMs or raw fastq data.
 """
 from . import snps
 from . import plink
+from . import counts
+from . import metrics
+from . import snpindex
+from . import annotation
 
-__all__ = ['snps', 'plink']
+__all__ = ['snps', 'plink', 'counts', 'metrics', 'snpindex', 'annotation']
@@ -0,0 +1,176 @@
+"""
+A compiled, memory mapped index of the features of a GTF/GFF annotation.
+
+============================================================================
+
+        AUTHOR: Michael D Dacre, mike.dacre@gmail.com
+  ORGANIZATION: Stanford University
+       LICENSE: MIT License, property of Stanford, use as you wish
+
+   DESCRIPTION: GetGeneASE only needs the lines of one feature type (column
+                3, e.g. exon) of an annotation, grouped by one attribute of
+                column 9 (e.g. gene_id). The first time an annotation is
+                loaded with a type and identifier, those lines are saved
+                in file order as numpy arrays, in a
+                [GFF].[TYPE].[IDENTIFIER].annidx directory next to it (see
+                ASEr.cache):
+                    info.json:       chromosome names, type, identifier,
+                                     and the size, mtime and md5 of the GFF
+                    names.npy:       feature names, by first appearance
+                    feature_ids.npy: index into names of every line
+                    chrom_ids.npy:   index into chroms of every line
+                    strands.npy:     strand (column 7) of every line
+                    starts.npy:      1-based start (column 4) of every line
+                    ends.npy:        1-based end (column 5) of every line
+                Later loads with the same type and identifier memory map
+                these arrays, until the annotation changes.
+
+============================================================================
+"""
+import re
+
+import numpy as np
+
+from . import logme
+from .run import open_zipped
+from .cache import load_cache, save_cache
+
+__all__ = ['Annotation', 'AnnotationError', 'load_annotation']
+
+# Indices of an older layout are rebuilt
+INDEX_VERSION = 1
+
+# Appended to the annotation file name, after the type and identifier
+INDEX_EXT = '.annidx'
+
+
+class AnnotationError(Exception):
+
+    """An annotation line without the identifier attribute."""
+
+    pass
+
+
+class Annotation(object):
+
+    """The lines of one feature type of an annotation, in file order."""
+
+    def __init__(self, names, chroms, feature_ids, chrom_ids, strands,
+                 starts, ends):
+        """Wrap the arrays of an index, see the module description."""
+        self.names       = names
+        self.chroms      = chroms
+        self.feature_ids = feature_ids
+        self.chrom_ids   = chrom_ids
+        self.strands     = strands
+        self.starts      = starts
+        self.ends        = ends
+
+    def __len__(self):
+        """Return the number of lines."""
+        return len(self.feature_ids)
+
+
+def load_annotation(gff_file, feature_type='exon', identifier='gene_id'):
+    """Return the Annotation of one feature type, building it if needed.
+
+    :gff_file:     A GTF or GFF file, gzipped OK.
+    :feature_type: Only lines of this type (column 3) are kept.
+    :identifier:   The attribute of column 9 features are named by.
+    :raises:       AnnotationError if a line of feature_type has no
+                   identifier attribute.
+    """
+    index_dir = '{}.{}.{}{}'.format(gff_file, _safe(feature_type),
+                                    _safe(identifier), INDEX_EXT)
+    cached    = load_cache(index_dir, gff_file, INDEX_VERSION)
+    if cached and cached[0]['type'] == feature_type and \
+            cached[0]['identifier'] == identifier:
+        info, arrays = cached
+        return Annotation(arrays['names'], info['chroms'],
+                          arrays['feature_ids'], arrays['chrom_ids'],
+                          arrays['strands'], arrays['starts'], arrays['ends'])
+
+    logme.log('Building {} {} index of {}'.format(
+        feature_type, identifier, gff_file), 'debug')
+    annotation = _parse_gff(gff_file, feature_type, identifier)
+    try:
+        save_cache(index_dir, gff_file, INDEX_VERSION,
+                   {'chroms': annotation.chroms, 'type': feature_type,
+                    'identifier': identifier},
+                   {'names': annotation.names,
+                    'feature_ids': annotation.feature_ids,
+                    'chrom_ids': annotation.chrom_ids,
+                    'strands': annotation.strands,
+                    'starts': annotation.starts, 'ends': annotation.ends})
+    except (IOError, OSError) as err:
+        logme.log('Could not save the annotation index of {}: {}'.format(
+            gff_file, err), 'debug')
+    return annotation
+
+
+def feature_name(info, identifier):
+    """Return the value of the identifier attribute of a column 9 string.
+
+    Both GFF (attribute=value;) and GTF (attribute "value";) are accepted.
+
+    :raises: AnnotationError if there is no identifier attribute.
+    """
+    name = None
+    if identifier + '=' in info:    # GFF
+        for i in info.split(';'):
+            if identifier + '=' in i:
+                name = i.split('=')[1]
+
+    elif identifier + ' ' in info:  # GTF
+        for i in info.split(';'):
+            if identifier in i:
+                name = i.split('"')[1]
+
+    else:
+        raise AnnotationError(
+            'ID attribute "{}" doesn\'t exist or GFF/GTF file '.format(
+                identifier) + 'not properly formatted.')
+    return name
+
+
+def _parse_gff(gff_file, feature_type, identifier):
+    """Read the lines of one feature type into an Annotation in memory."""
+    names       = []
+    name_index  = {}
+    chroms      = []
+    chrom_index = {}
+    feature_ids = []
+    chrom_ids   = []
+    strands     = []
+    starts      = []
+    ends        = []
+    with open_zipped(gff_file) as fin:
+        for line in fin:
+            if line.startswith('#'):
+                continue
+            line_t = line.rstrip('\n').split('\t')
+            if line_t[2] != feature_type:
+                continue
+            name = feature_name(line_t[8], identifier)
+            if name not in name_index:
+                name_index[name] = len(names)
+                names.append(name)
+            if line_t[0] not in chrom_index:
+                chrom_index[line_t[0]] = len(chroms)
+                chroms.append(line_t[0])
+            feature_ids.append(name_index[name])
+            chrom_ids.append(chrom_index[line_t[0]])
+            strands.append(line_t[6])
+            starts.append(int(line_t[3]))
+            ends.append(int(line_t[4]))
+    return Annotation(np.array(names, dtype=str), chroms,
+                      np.array(feature_ids, dtype=np.int32),
+                      np.array(chrom_ids, dtype=np.int32),
+                      np.array(strands, dtype=str),
+                      np.array(starts, dtype=np.int64),
+                      np.array(ends, dtype=np.int64))
+
+
+def _safe(value):
+    """Return value with anything but letters, digits, . and - replaced."""
+    return re.sub(r'[^A-Za-z0-9.-]', '_', value)
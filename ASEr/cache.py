@@ -0,0 +1,126 @@
+"""
+Memory mapped numpy array caches of parsed input files.
+
+============================================================================
+
+        AUTHOR: Michael D Dacre, mike.dacre@gmail.com
+  ORGANIZATION: Stanford University
+       LICENSE: MIT License, property of Stanford, use as you wish
+
+   DESCRIPTION: A cache is a directory next to its source file, holding one
+                .npy file per array and an info.json with the size, mtime
+                and md5 of the source, the cache version, and any other
+                small values the caller wants to keep (names, offsets).
+
+                load_cache() memory maps the arrays, as long as the source
+                still has the same size and mtime, or the same md5 if only
+                the mtime changed. save_cache() writes a new cache to a
+                temporary directory and moves it into place, so jobs that
+                build the same cache at once never see half of one.
+
+============================================================================
+"""
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+
+__all__ = ['load_cache', 'save_cache', 'file_md5']
+
+
+def load_cache(cache_dir, source, version):
+    """Return (info, arrays) of the cache of source, None if it is stale.
+
+    :cache_dir: The cache directory.
+    :source:    The file the cache was built from.
+    :version:   The layout version the caller expects.
+    :returns:   The info dictionary and a dictionary of name => memory
+                mapped array, or None if there is no valid cache.
+    """
+    info = _read_info(cache_dir)
+    stat = os.stat(source)
+    if not info or info.get('version') != version or \
+            info['size'] != stat.st_size:
+        return None
+    if info['mtime'] != stat.st_mtime:
+        # Touched or copied, but maybe not changed
+        if info['md5'] != file_md5(source):
+            return None
+        info['mtime'] = stat.st_mtime
+        try:
+            _write_info(cache_dir, info)
+        except (IOError, OSError):
+            pass
+    return info, dict([(i, np.load(os.path.join(cache_dir, i + '.npy'),
+                                   mmap_mode='r'))
+                       for i in info['arrays']])
+
+
+def save_cache(cache_dir, source, version, info, arrays):
+    """Write a cache of source.
+
+    If another job moved a cache of the same source and version into place
+    first, that one is kept, only a stale cache is replaced.
+
+    :info:   A JSON serializable dictionary, the size, mtime and md5 of
+             source are added to it.
+    :arrays: A dictionary of name => numpy array, not of objects.
+    :raises: IOError or OSError if the cache cannot be written.
+    """
+    stat = os.stat(source)
+    info = dict(info)
+    info.update({'version': version, 'size': stat.st_size,
+                 'mtime': stat.st_mtime, 'md5': file_md5(source),
+                 'arrays': sorted(arrays)})
+    temp_dir = tempfile.mkdtemp(prefix='.cache', dir=os.path.dirname(
+        os.path.abspath(cache_dir)))
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(temp_dir, name + '.npy'), array)
+        _write_info(temp_dir, info)
+        if _same_source(_read_info(cache_dir), info):
+            return
+        if os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        try:
+            os.rename(temp_dir, cache_dir)
+        except OSError:
+            # Another job moved its cache into place since the check
+            if not _same_source(_read_info(cache_dir), info):
+                raise
+    finally:
+        if os.path.isdir(temp_dir):
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def file_md5(infile):
+    """Return the md5 hex digest of a file."""
+    md5 = hashlib.md5()
+    with open(infile, 'rb') as fin:
+        for block in iter(lambda: fin.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _same_source(existing, info):
+    """Return True if the info of a cache matches the info of a new one."""
+    return bool(existing) and all([existing.get(i) == info[i] for i in
+                                   ['version', 'size', 'md5', 'arrays']])
+
+
+def _read_info(cache_dir):
+    """Return the info.json of a cache, None if it is missing."""
+    try:
+        with open(os.path.join(cache_dir, 'info.json')) as fin:
+            return json.load(fin)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write_info(cache_dir, info):
+    """Write the info.json of a cache."""
+    with open(os.path.join(cache_dir, 'info.json'), 'w') as fout:
+        json.dump(info, fout)
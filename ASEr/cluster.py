@@ -73,6 +73,12 @@ ALLOWED_QUEUES = ['torque', 'slurm', 'normal']
 
 POOL = None
 
+##############################################################
+#  Profile python jobs to PROFILE.NAME, see run.profile_name  #
+##############################################################
+
+PROFILE = None
+
 # Reset broken multithreading
 # Some of the numpy C libraries can break multithreading, this command
 # fixes the issue.
@@ -218,6 +224,9 @@ def submit(command, name, threads=None, time=None, cores=None, mem=None,
     """
     check_queue()  # Make sure the QUEUE is usable
 
+    if PROFILE:
+        command = profile_command(command, run.profile_name(PROFILE, name))
+
     if QUEUE == 'slurm' or QUEUE == 'torque':
         return submit_file(make_job_file(command, name, time, cores,
                                          mem, partition, modules, path),
@@ -227,6 +236,15 @@ def submit(command, name, threads=None, time=None, cores=None, mem=None,
                            threads=threads)
 
 
+def profile_command(command, profile):
+    """Run a python command under cProfile, writing the stats to profile.
+
+    Commands that do not start with python are returned unchanged.
+    """
+    return re.sub(r'^(\s*python[0-9.]*)\s',
+                  r'\1 -m cProfile -o {} '.format(profile), command)
+
+
 def submit_file(script_file, name=None, dependencies=None, threads=None):
     """Submit a job file to the cluster.
 
@@ -0,0 +1,449 @@
+"""
+Array backed storage of per-SNP allele counts.
+
+============================================================================
+
+        AUTHOR: Michael D Dacre, mike.dacre@gmail.com
+  ORGANIZATION: Stanford University
+       LICENSE: MIT License, property of Stanford, use as you wish
+
+   DESCRIPTION: SNPs are stored per chromosome as a sorted array of 1-based
+                positions, all counts are kept in a single integer matrix
+                of shape (n_snps, 2, 4): strand (+, -) by base (A, C, G, T).
+                A SNP is addressed by its ordinal, which is its row in the
+                matrix, so no per-SNP strings or lists are ever created.
+
+                Count files can be written as text, or as a binary numpy
+                .npz file holding the same rows as columns:
+                    chroms:    chromosome names
+                    chrom_ids: index into chroms of every row
+                    positions: 1-based SNP positions
+                    counts:    (rows, 2, 4) counts
+                read_count_file() reads either format into these arrays.
+
+============================================================================
+"""
+from heapq import merge
+from itertools import groupby
+from operator import itemgetter
+
+import numpy as np
+
+from .run import open_zipped
+from .snps import chrom_to_num
+from .snpindex import load_snp_index
+
+__all__ = ['SNPCounts', 'write_matrix', 'read_count_file',
+           'merge_count_files', 'pack_hit']
+
+# Column of each base and strand in the count matrix
+BASES   = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+STRANDS = {'+': 0, '-': 1}
+
+# Column of every byte of a packed base, -1 for anything but ACGT
+BASE_CODES = np.full(256, -1, dtype=np.int64)
+for _base, _column in BASES.items():
+    BASE_CODES[ord(_base)] = _column
+
+# First bytes of an npz (zip) file
+NPZ_MAGIC = b'PK\x03\x04'
+
+# Rows formatted at a time when writing text
+CHUNK_SIZE = 100000
+
+HEADER = ('CHR\tPOSITION\tPOS_A|C|G|T\tNEG_A|C|G|T\t' +
+          'SUM_POS_READS\tSUM_NEG_READS\tSUM_READS\n')
+
+
+class SNPCounts(object):
+
+    """Allele counts on both strands for a fixed set of SNPs."""
+
+    def __init__(self, positions, index=None):
+        """Create an empty count matrix.
+
+        :positions: A dictionary of chromosome => iterable of 1-based SNP
+                    positions, duplicates are removed.
+        :index:     A SNPIndex to load any other chromosome from the first
+                    time it is looked up, see from_bed().
+        """
+        self.chroms    = sorted(positions)
+        self.positions = {}
+        self.offsets   = {}
+        total = 0
+        for chrom in self.chroms:
+            pos_array = np.unique(np.asarray(positions[chrom], dtype=np.int64))
+            self.positions[chrom] = pos_array
+            self.offsets[chrom]   = total
+            total += len(pos_array)
+        self.counts = np.zeros((total, 2, 4), dtype=np.uint32)
+        # SNPs that have had at least one read assigned, even if the read
+        # base was not A, C, G, or T. Only these are written out.
+        self.seen   = np.zeros(total, dtype=bool)
+        self.index  = index
+
+    @classmethod
+    def from_bed(cls, bed_file, chroms=None, lazy=False):
+        """Create an empty SNPCounts from a BED file of SNPs.
+
+        Chromosome names are standardized with chrom_to_num, the 1-based
+        position is taken from the third column. The BED is read through its
+        cached SNP index, see ASEr.snpindex.
+
+        :chroms: Only load the SNPs of these chromosomes, default is all.
+        :lazy:   Load the SNPs of any other chromosome the first time a read
+                 on it is looked up, instead of never counting it.
+        """
+        index     = load_snp_index(bed_file)
+        wanted    = set([chrom_to_num(i) for i in chroms]) \
+            if chroms is not None else None
+        positions = {}
+        for chrom, pos_array in index.positions_by_chrom().items():
+            chrom = chrom_to_num(chrom)
+            if wanted is not None and chrom not in wanted:
+                continue
+            if chrom in positions:  # Both chr1 and 1 in the BED
+                pos_array = np.concatenate([positions[chrom], pos_array])
+            positions[chrom] = pos_array
+        return cls(positions, index if wanted is not None and lazy else None)
+
+    def empty_like(self):
+        """Return a new, empty SNPCounts on the same SNPs.
+
+        The position arrays are shared, not copied, so many samples can be
+        counted against one loaded SNP list.
+        """
+        new = self.__class__.__new__(self.__class__)
+        new.chroms    = list(self.chroms)
+        new.positions = dict(self.positions)
+        new.offsets   = dict(self.offsets)
+        new.counts    = np.zeros_like(self.counts)
+        new.seen      = np.zeros_like(self.seen)
+        new.index     = self.index
+        return new
+
+    def sparse(self):
+        """Return (ordinals, counts) of only the seen SNPs."""
+        ordinals = np.flatnonzero(self.seen)
+        return ordinals, self.counts[ordinals]
+
+    def __len__(self):
+        """Return the number of SNPs."""
+        return len(self.seen)
+
+    def ordinal(self, chrom, pos):
+        """Return the ordinal of the SNP at chrom:pos (1-based), or -1."""
+        pos_array = self.positions.get(chrom)
+        if pos_array is None and self.index is not None:
+            pos_array = self._load_chrom(chrom)
+        if pos_array is None:
+            return -1
+        i = pos_array.searchsorted(pos)
+        if i < len(pos_array) and pos_array[i] == pos:
+            return self.offsets[chrom] + int(i)
+        return -1
+
+    def overlaps(self, chrom, start, end):
+        """Return True if any SNP lies in the 0-based, half-open start-end.
+
+        This is a cheap test on the sorted positions, used to drop reads
+        before any of their tags are decoded.
+        """
+        pos_array = self.positions.get(chrom)
+        if pos_array is None and self.index is not None:
+            pos_array = self._load_chrom(chrom)
+        if pos_array is None:
+            return False
+        i = pos_array.searchsorted(start + 1)
+        return i < len(pos_array) and pos_array[i] <= end
+
+    def _load_chrom(self, chrom):
+        """Append the SNPs of chrom from self.index to the matrix.
+
+        Ordinals of the SNPs already loaded do not change, so this is safe
+        while counting.
+
+        :returns: The positions of chrom, empty if it has no SNPs.
+        """
+        parts = [self.index.positions[self.index.chrom_rows(i)]
+                 for i in self.index.chroms if chrom_to_num(i) == chrom]
+        pos_array = np.unique(np.concatenate(parts)) if parts \
+            else np.zeros(0, dtype=np.int64)
+        self.chroms = sorted(self.chroms + [chrom])
+        self.positions[chrom] = pos_array
+        self.offsets[chrom]   = len(self.seen)
+        self.counts = np.concatenate([self.counts, np.zeros(
+            (len(pos_array), 2, 4), dtype=np.uint32)])
+        self.seen   = np.concatenate([self.seen, np.zeros(len(pos_array),
+                                                          dtype=bool)])
+        return pos_array
+
+    def add(self, ordinal, base, strand):
+        """Add one read with base on strand ('+' or '-') to a SNP."""
+        self.seen[ordinal] = True
+        if base in BASES:
+            self.counts[ordinal, STRANDS[strand], BASES[base]] += 1
+
+    def add_packed(self, packed):
+        """Add many reads at once, each packed into one integer by pack_hit().
+
+        :packed: An int64 numpy array of packed SNP hits.
+        """
+        ordinals = packed >> 9
+        columns  = BASE_CODES[(packed >> 1) & 0xff]
+        self.seen[ordinals] = True
+        known = columns >= 0
+        np.add.at(self.counts, (ordinals[known], (packed & 1)[known],
+                                columns[known]), 1)
+
+    def add_sparse(self, ordinals, counts):
+        """Add the (ordinals, counts) returned by sparse() of another
+        SNPCounts built on the same SNPs."""
+        self.counts[ordinals] += counts
+        self.seen[ordinals]    = True
+
+    def rows(self):
+        """Yield (chrom, positions, ordinals) arrays of the seen SNPs.
+
+        Rows are sorted by their 'chr|pos' string, which is the order the
+        SNP_COUNTS files have always been written in, one chromosome at a
+        time: chromosomes are sorted on chrom + '|', and the positions of
+        each one as strings, without a string per SNP ever being kept.
+        """
+        for chrom in sorted(self.chroms, key=lambda i: i + '|'):
+            offset  = self.offsets[chrom]
+            size    = len(self.positions[chrom])
+            index   = np.flatnonzero(self.seen[offset:offset+size])
+            if not len(index):
+                continue
+            positions = self.positions[chrom][index]
+            width     = len(str(positions.max()))
+            order     = np.argsort(positions.astype('S{}'.format(width)),
+                                   kind='mergesort')
+            yield chrom, positions[order], offset + index[order]
+
+    def write(self, outfile, binary=False):
+        """Write a SNP_COUNTS file of all seen SNPs.
+
+        :binary: Write a binary .npz file instead of text.
+        """
+        if binary:
+            chroms    = []
+            chrom_ids = []
+            positions = []
+            ordinals  = []
+            for chrom, chrom_positions, chrom_ordinals in self.rows():
+                chrom_ids.append(np.full(len(chrom_positions), len(chroms),
+                                         dtype=np.int32))
+                chroms.append(chrom)
+                positions.append(chrom_positions)
+                ordinals.append(chrom_ordinals)
+            _save_npz(outfile, chroms, _concatenate(chrom_ids, np.int32),
+                      _concatenate(positions, np.int64),
+                      self.counts[_concatenate(ordinals, np.int64)])
+            return
+
+        with open_zipped(outfile, 'w') as fout:
+            fout.write(HEADER)
+            for chrom, positions, ordinals in self.rows():
+                for start in range(0, len(ordinals), CHUNK_SIZE):
+                    chunk = slice(start, start + CHUNK_SIZE)
+                    fout.write(''.join([
+                        _format_row(chrom, pos, counts[0], counts[1])
+                        for pos, counts in zip(
+                            positions[chunk].tolist(),
+                            self.counts[ordinals[chunk]].tolist())]))
+
+
+def write_matrix(snps, samples, outfile):
+    """Write the counts of many samples as a single SNPs x samples table.
+
+    Every SNP seen in any sample gets a row, with two columns per sample in
+    the same A|C|G|T format as a SNP_COUNTS file. Rows are formatted a
+    chunk at a time, so only the counts of one chunk are ever held as
+    Python integers.
+
+    :snps:    A SNPCounts object with the SNP layout of all samples.
+    :samples: A list of (name, ordinals, counts) tuples, as returned by
+              SNPCounts.sparse().
+    """
+    layout = snps.empty_like()
+    for _, ordinals, _ in samples:
+        layout.seen[ordinals] = True
+
+    # One format for the 8 counts of every sample, so a row is one operation
+    row_format = '\t'.join(['%d|%d|%d|%d'] * 2 * len(samples)) + '\n'
+    chunk_size = max(1, CHUNK_SIZE // max(1, len(samples)))
+
+    with open_zipped(outfile, 'w') as fout:
+        header = ['CHR', 'POSITION']
+        for name, _, _ in samples:
+            header += [name + '_POS_A|C|G|T', name + '_NEG_A|C|G|T']
+        fout.write('\t'.join(header) + '\n')
+        for chrom, positions, ordinals in layout.rows():
+            for start in range(0, len(ordinals), chunk_size):
+                chunk  = ordinals[start:start+chunk_size]
+                counts = np.hstack([
+                    _sample_counts(chunk, sample_ordinals, sample_counts)
+                    for _, sample_ordinals, sample_counts in samples])
+                fout.write(''.join([
+                    chrom + '\t' + str(pos) + '\t' + row_format % tuple(row)
+                    for pos, row in zip(
+                        positions[start:start+chunk_size].tolist(),
+                        counts.tolist())]))
+
+
+def _sample_counts(ordinals, sample_ordinals, sample_counts):
+    """Return the (ordinals, 8) counts of one sample, zero where unseen.
+
+    :sample_ordinals: The sorted ordinals of the SNPs the sample has seen.
+    """
+    counts = np.zeros((len(ordinals), 8), dtype=np.uint32)
+    if len(sample_ordinals):
+        index = np.searchsorted(sample_ordinals, ordinals)
+        index[index == len(sample_ordinals)] = 0
+        found = sample_ordinals[index] == ordinals
+        counts[found] = sample_counts[index[found]].reshape(-1, 8)
+    return counts
+
+
+def pack_hit(ordinal, base, strand):
+    """Pack one read at one SNP into an integer, see SNPCounts.add_packed().
+
+    Packed hits sort in the same order as (ordinal, base, strand) tuples.
+    """
+    return ordinal << 9 | ord(base) << 1 | (strand == '-')
+
+
+def merge_count_files(count_files, outfile, binary=False):
+    """Merge sorted SNP_COUNTS files into one, summing counts of shared SNPs.
+
+    The files are read in step with a heap merge, so only one row of each
+    file is held at a time, and the output is in the same 'chr|pos' order
+    as the inputs without any further sorting.
+
+    :count_files: A list of text or binary SNP_COUNTS files, in any mix.
+    :outfile:     The merged file to write.
+    :binary:      Write a binary .npz file instead of text.
+    """
+    rows = merge(*[_count_rows(i) for i in count_files])
+
+    if binary:
+        # np.savez needs whole columns, so only the output is collected
+        chroms    = []
+        chrom_ids = []
+        positions = []
+        counts    = []
+        for chrom, pos, total in _sum_rows(rows):
+            if not chroms or chroms[-1] != chrom:
+                chroms.append(chrom)
+            chrom_ids.append(len(chroms) - 1)
+            positions.append(pos)
+            counts.append(total)
+        _save_npz(outfile, chroms, chrom_ids, positions,
+                  np.array(counts, dtype=np.uint32).reshape(-1, 2, 4))
+        return
+
+    with open_zipped(outfile, 'w') as fout:
+        fout.write(HEADER)
+        for chrom, pos, total in _sum_rows(rows):
+            fout.write(_format_row(chrom, pos, total[:4], total[4:]))
+
+
+def _sum_rows(rows):
+    """Collapse consecutive rows of the same SNP into (chrom, pos, counts)."""
+    for _, snp_rows in groupby(rows, itemgetter(0)):
+        _, chrom, pos, total = next(snp_rows)
+        for row in snp_rows:
+            total = [i + j for i, j in zip(total, row[3])]
+        yield chrom, pos, total
+
+
+def _count_rows(count_file):
+    """Yield (key, chrom, pos, counts) for every row of a SNP_COUNTS file.
+
+    key is the 'chr|pos' string files are sorted on, counts is a flat list
+    of the positive then the negative strand counts.
+    """
+    if is_binary(count_file):
+        data   = read_count_file(count_file)
+        chroms = data['chroms'].tolist()
+        for chrom_id, pos, counts in zip(data['chrom_ids'].tolist(),
+                                         data['positions'].tolist(),
+                                         data['counts'].tolist()):
+            chrom = chroms[chrom_id]
+            yield chrom + '|' + str(pos), chrom, pos, counts[0] + counts[1]
+        return
+
+    with open_zipped(count_file) as fin:
+        for line in fin:
+            if line.startswith('CHR\t'):
+                continue
+            line_t = line.rstrip('\n').split('\t')
+            yield (line_t[0] + '|' + line_t[1], line_t[0], int(line_t[1]),
+                   [int(i) for i in line_t[2].split('|') +
+                    line_t[3].split('|')])
+
+
+def _format_row(chrom, pos, pos_counts, neg_counts):
+    """Return one line of a text SNP_COUNTS file."""
+    sum_pos = sum(pos_counts)
+    sum_neg = sum(neg_counts)
+    return '\t'.join([
+        chrom, str(pos), '|'.join([str(i) for i in pos_counts]),
+        '|'.join([str(i) for i in neg_counts]), str(sum_pos), str(sum_neg),
+        str(sum_pos + sum_neg)]) + '\n'
+
+
+def _concatenate(arrays, dtype):
+    """Return the concatenation of a list of arrays, which may be empty."""
+    return np.concatenate(arrays) if arrays else np.zeros(0, dtype=dtype)
+
+
+def _save_npz(outfile, chroms, chrom_ids, positions, counts):
+    """Write the columns of a binary SNP_COUNTS file."""
+    with open(outfile, 'wb') as fout:
+        np.savez(fout, chroms=np.array(chroms, dtype=str),
+                 chrom_ids=np.array(chrom_ids, dtype=np.int32),
+                 positions=np.array(positions, dtype=np.int64),
+                 counts=counts)
+
+
+def is_binary(count_file):
+    """Return True if count_file is a binary (npz) SNP_COUNTS file."""
+    with open(count_file, 'rb') as fin:
+        return fin.read(len(NPZ_MAGIC)) == NPZ_MAGIC
+
+
+def read_count_file(count_file):
+    """Read a text or binary SNP_COUNTS file into arrays.
+
+    :returns: A dictionary of the arrays 'chroms', 'chrom_ids', 'positions'
+              and 'counts', see the module description.
+    """
+    if is_binary(count_file):
+        with np.load(count_file) as data:
+            return dict([(i, data[i]) for i in
+                         ['chroms', 'chrom_ids', 'positions', 'counts']])
+
+    chroms      = []
+    chrom_index = {}
+    chrom_ids   = []
+    positions   = []
+    counts      = []
+    with open_zipped(count_file) as fin:
+        for line in fin:
+            if line.startswith('CHR\t'):
+                continue
+            line_t = line.rstrip('\n').split('\t')
+            if line_t[0] not in chrom_index:
+                chrom_index[line_t[0]] = len(chroms)
+                chroms.append(line_t[0])
+            chrom_ids.append(chrom_index[line_t[0]])
+            positions.append(int(line_t[1]))
+            counts.append([[int(i) for i in line_t[2].split('|')],
+                           [int(i) for i in line_t[3].split('|')]])
+    return {'chroms':    np.array(chroms, dtype=str),
+            'chrom_ids': np.array(chrom_ids, dtype=np.int32),
+            'positions': np.array(positions, dtype=np.int64),
+            'counts':    np.array(counts, dtype=np.uint32).reshape(-1, 2, 4)}
@@ -0,0 +1,140 @@
+"""
+Wall time, throughput and memory metrics of one run or many workers.
+
+============================================================================
+
+        AUTHOR: Michael D Dacre, mike.dacre@gmail.com
+  ORGANIZATION: Stanford University
+       LICENSE: MIT License, property of Stanford, use as you wish
+
+   DESCRIPTION: A Metrics object adds up the wall time spent in each phase
+                of a run (e.g. decode, filter, md_parse, assignment, output)
+                and any counters, logs a progress line every
+                PROGRESS_INTERVAL seconds, and writes it all to a JSON file.
+                The metrics of many workers are combined with aggregate().
+
+                Each JSON file holds:
+                    name:             The run or worker name
+                    reads:            Reads processed
+                    wall_seconds:     Time since the Metrics was created
+                    reads_per_second: reads/wall_seconds
+                    phases:           phase => {seconds, reads_per_second}
+                    counters:         counter => value
+                    max_rss_mb:       Peak resident memory of the process
+                    workers:          The metrics of each worker, only if
+                                      aggregated
+
+============================================================================
+"""
+import json
+import resource
+from time import time
+
+from . import logme
+
+__all__ = ['Metrics', 'aggregate', 'read_metrics', 'write_metrics']
+
+# Seconds between two progress lines
+PROGRESS_INTERVAL = 30
+
+
+class Metrics(object):
+
+    """Phase timings and counters of one run or worker."""
+
+    def __init__(self, name):
+        """Start the wall clock of a run called name."""
+        self.name     = name
+        self.start    = time()
+        self.last_log = self.start
+        self.reads    = 0
+        self.phases   = {}
+        self.counters = {}
+
+    def add(self, phase, seconds):
+        """Add seconds of wall time to phase."""
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def count(self, counters):
+        """Add a dictionary of counters to the totals."""
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def progress(self, reads):
+        """Log a progress line if PROGRESS_INTERVAL seconds have passed.
+
+        :reads: The number of reads processed so far by the current step.
+        """
+        now = time()
+        if now - self.last_log < PROGRESS_INTERVAL:
+            return
+        self.last_log = now
+        logme.log('{}: {} reads, {:.0f} reads/s'.format(
+            self.name, self.reads + reads,
+            (self.reads + reads)/(now - self.start)))
+
+    def as_dict(self):
+        """Return all metrics as a dictionary, see the module description."""
+        wall = time() - self.start
+        return {'name': self.name, 'reads': self.reads,
+                'wall_seconds': wall,
+                'reads_per_second': _rate(self.reads, wall),
+                'phases': dict([(i, {'seconds': j,
+                                     'reads_per_second': _rate(self.reads, j)})
+                                for i, j in self.phases.items()]),
+                'counters': self.counters,
+                'max_rss_mb': _max_rss()}
+
+
+def aggregate(name, workers, wall=None):
+    """Combine the metrics dictionaries of many workers.
+
+    Phase times, reads and counters are summed over all workers, so phase
+    rates are per process, memory is the peak of any worker or this process.
+
+    :workers: A list of dictionaries from Metrics.as_dict() or read_metrics().
+    :wall:    Wall time of the whole run, default is the slowest worker.
+    :returns: A dictionary in the same format, with a list of workers added.
+    """
+    reads    = sum([i['reads'] for i in workers])
+    phases   = {}
+    counters = {}
+    for worker in workers:
+        for phase, values in worker['phases'].items():
+            phases[phase] = phases.get(phase, 0.0) + values['seconds']
+        for key, value in worker['counters'].items():
+            counters[key] = counters.get(key, 0) + value
+    if wall is None:
+        wall = max([i['wall_seconds'] for i in workers] or [0])
+    return {'name': name, 'reads': reads, 'wall_seconds': wall,
+            'reads_per_second': _rate(reads, wall),
+            'phases': dict([(i, {'seconds': j,
+                                 'reads_per_second': _rate(reads, j)})
+                            for i, j in phases.items()]),
+            'counters': counters,
+            'max_rss_mb': max([_max_rss()] +
+                              [i['max_rss_mb'] for i in workers]),
+            'workers': workers}
+
+
+def read_metrics(infile):
+    """Return the dictionary stored in a metrics JSON file."""
+    with open(infile) as fin:
+        return json.load(fin)
+
+
+def write_metrics(metrics, outfile):
+    """Write a metrics dictionary to a JSON file."""
+    with open(outfile, 'w') as fout:
+        json.dump(metrics, fout, indent=2, sort_keys=True)
+        fout.write('\n')
+
+
+def _rate(reads, seconds):
+    """Return reads per second, 0 if no time was spent."""
+    return reads/seconds if seconds else 0.0
+
+
+def _max_rss():
+    """Return the peak resident memory of this process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
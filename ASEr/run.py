@@ -12,15 +12,18 @@ File management and execution functions.
 ============================================================================
 """
 import os
+import sys
 import gzip
 import bz2
+import pstats
+import cProfile
 import argparse
 from subprocess import Popen
 from subprocess import PIPE
 
 from . import logme
 
-__all__ = ['cmd', 'which', 'open_zipped']
+__all__ = ['cmd', 'which', 'open_zipped', 'profile_main', 'merge_profiles']
 
 
 ###############################################################################
@@ -209,3 +212,64 @@ def split_file(infile, parts, outpath='', keep_header=True):
                 cnt = 0
         sfile.close()
     return tuple(outfiles)
+
+
+###############################################################################
+#                                  Profiling                                  #
+###############################################################################
+
+
+def add_profile_argument(parser):
+    """Add the common --profile option to a parser or argument group."""
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Write a cProfile (pstats) dump of this run to ' +
+                        'FILE, and of every job or worker process it starts ' +
+                        'to FILE.NAME (e.g. run.prof => run.NAME.prof)')
+
+
+def profile_name(profile, name):
+    """Return the profile file of the job or worker name.
+
+    The extension of profile is kept, e.g. run.prof => run.NAME.prof.
+    """
+    root, ext = os.path.splitext(profile)
+    return '{}.{}{}'.format(root, os.path.basename(name), ext)
+
+
+def profile_call(profile, function, *args, **kwargs):
+    """Call function, under cProfile if profile is a file name.
+
+    :profile: Where to dump the pstats, if None function is just called.
+    :returns: The return value of function.
+    """
+    if not profile:
+        return function(*args, **kwargs)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args, **kwargs)
+    finally:
+        profiler.dump_stats(profile)
+
+
+def profile_main(main, argv=None):
+    """Run the main() of a script, under cProfile if --profile FILE is set.
+
+    Only --profile is read here, main() still gets all arguments, so it has
+    to accept --profile too (see add_profile_argument()).
+    """
+    peek = argparse.ArgumentParser(add_help=False)
+    peek.add_argument('--profile')
+    known = peek.parse_known_args(sys.argv[1:] if argv is None else argv)[0]
+    return profile_call(known.profile, main, argv)
+
+
+def merge_profiles(profiles, outfile):
+    """Combine many pstats dumps into one, missing files are skipped.
+
+    :returns: The number of profiles merged.
+    """
+    profiles = [i for i in profiles if os.path.isfile(i)]
+    if not profiles:
+        return 0
+    pstats.Stats(*profiles).dump_stats(outfile)
+    return len(profiles)
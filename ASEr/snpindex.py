@@ -0,0 +1,138 @@
+"""
+A compiled, memory mapped index of the SNPs in a BED file.
+
+============================================================================
+
+        AUTHOR: Michael D Dacre, mike.dacre@gmail.com
+  ORGANIZATION: Stanford University
+       LICENSE: MIT License, property of Stanford, use as you wish
+
+   DESCRIPTION: Parsing a large SNP BED is slow, and every job that uses it
+                used to parse it again. The first time a BED is loaded its
+                SNPs are sorted by chromosome and position and saved as
+                numpy arrays in a [BED].snpidx directory next to it (see
+                ASEr.cache):
+                    info.json:     chromosome names, the row offset of
+                                   each chromosome, and the size, mtime and
+                                   md5 of the BED
+                    positions.npy: 1-based positions (third column)
+                    names.npy:     fourth column (a name or REF|ALT), as
+                                   bytes, empty if there is none
+                Later loads memory map these arrays, until the BED changes.
+                If the directory cannot be written, the BED is parsed every
+                time, as before.
+
+============================================================================
+"""
+import numpy as np
+
+from . import logme
+from .run import open_zipped
+from .cache import load_cache, save_cache
+
+__all__ = ['SNPIndex', 'load_snp_index']
+
+# Indices of an older layout are rebuilt
+INDEX_VERSION = 2
+
+# Appended to the BED file name
+INDEX_EXT = '.snpidx'
+
+
+class SNPIndex(object):
+
+    """The SNPs of a BED file as arrays sorted by chromosome and position."""
+
+    def __init__(self, chroms, offsets, positions, names):
+        """Wrap the arrays of an index.
+
+        :chroms:    A sorted list of chromosome names, as written in the BED.
+        :offsets:   The row of the first SNP of every chromosome, followed by
+                    the total number of SNPs.
+        :positions: An int64 array of 1-based positions.
+        :names:     A bytes array of the fourth BED column.
+        """
+        self.chroms    = chroms
+        self.offsets   = offsets
+        self.positions = positions
+        self.names     = names
+        self.chrom_ids = dict([(j, i) for i, j in enumerate(chroms)])
+
+    def __len__(self):
+        """Return the number of SNPs."""
+        return len(self.positions)
+
+    def chrom_rows(self, chrom):
+        """Return the slice of rows holding the SNPs of chrom."""
+        i = self.chrom_ids[chrom]
+        return slice(self.offsets[i], self.offsets[i+1])
+
+    def positions_by_chrom(self):
+        """Return a dictionary of chromosome => sorted position array."""
+        return dict([(i, self.positions[self.chrom_rows(i)])
+                     for i in self.chroms])
+
+    def name_list(self):
+        """Return the fourth column of every SNP as a list of strings."""
+        return self.names.astype(str).tolist()
+
+
+def load_snp_index(bed_file):
+    """Return the SNPIndex of bed_file, building and saving it if needed.
+
+    :bed_file: A BED file of SNPs, gzipped OK.
+    """
+    index_dir = bed_file + INDEX_EXT
+    cached    = load_cache(index_dir, bed_file, INDEX_VERSION)
+    if cached:
+        info, arrays = cached
+        return SNPIndex(info['chroms'], info['offsets'],
+                        arrays['positions'], arrays['names'])
+
+    logme.log('Building SNP index of {}'.format(bed_file), 'debug')
+    index = _parse_bed(bed_file)
+    try:
+        save_cache(index_dir, bed_file, INDEX_VERSION,
+                   {'chroms': index.chroms, 'offsets': index.offsets},
+                   {'positions': index.positions, 'names': index.names})
+    except (IOError, OSError) as err:
+        logme.log('Could not save the SNP index of {}: {}'.format(
+            bed_file, err), 'debug')
+    return index
+
+
+def _parse_bed(bed_file):
+    """Read a BED of SNPs into a SNPIndex held in memory.
+
+    Header, track and browser lines, or any other line without a position
+    in the third column, are skipped.
+    """
+    positions = {}
+    names     = {}
+    with open_zipped(bed_file) as fin:
+        for line in fin:
+            line_t = line.rstrip('\n').split('\t')
+            if len(line_t) < 3 or not line_t[2].strip().isdigit():
+                continue
+            chrom = line_t[0]
+            if chrom not in positions:
+                positions[chrom] = []
+                names[chrom]     = []
+            positions[chrom].append(int(line_t[2]))
+            names[chrom].append(line_t[3] if len(line_t) > 3 else '')
+
+    chroms     = sorted(positions)
+    offsets    = [0]
+    pos_parts  = []
+    name_parts = []
+    for chrom in chroms:
+        pos_array = np.array(positions[chrom], dtype=np.int64)
+        order     = np.argsort(pos_array, kind='mergesort')
+        pos_parts.append(pos_array[order])
+        name_parts.append(np.array(names[chrom], dtype=bytes)[order])
+        offsets.append(offsets[-1] + len(pos_array))
+    return SNPIndex(chroms, offsets,
+                    np.concatenate(pos_parts) if pos_parts
+                    else np.zeros(0, dtype=np.int64),
+                    np.concatenate(name_parts) if name_parts
+                    else np.zeros(0, dtype=bytes))
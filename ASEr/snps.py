@@ -22,6 +22,7 @@ from .plink import PlinkError
 from .run import open_zipped
 from .run import is_file_type
 from .run import write_iterable
+from .snpindex import load_snp_index
 
 # Logging
 from . import logme
@@ -256,12 +257,12 @@ def get_het_snps_from_recodeAD(infile, snps=None, individuals=None,
 
 
 def snps_from_bed(snp_file):
-    """Return a frozenset of SNP names from a bed file."""
-    snps = []
-    with open_zipped(snp_file) as fin:
-        for i in fin:
-            snps.append(i.split('\t')[3])
-    return frozenset(snps)
+    """Return a frozenset of SNP names from a bed file.
+
+    The names are read from the cached SNP index of the file, see
+    ASEr.snpindex.
+    """
+    return frozenset(load_snp_index(snp_file).name_list())
 
 
 def filter_snps_by_exon(snp_file, exon_file, outfile=None, outbed=False):
@@ -24,19 +24,48 @@ import sys                 # Access to simple command-line arguments
 import argparse            # Access to long command-line parsing
 import re                  # Access to REGEX splitting
 import random              # Access to random number generation
+import zlib                # Fast read name hashing
+import struct              # Unpack hash digests
+import hashlib             # Independent read name hash
 from time import sleep     # Allow system pausing
-from multiprocessing import cpu_count
+from time import time      # Phase timing
+from heapq import heappush, heappop
+from itertools import groupby
+from operator import attrgetter
+from multiprocessing import Pool, cpu_count
 from pysam import Samfile  # Read sam and bamfiles
+import numpy as np         # Typed arrays
 
 # Us
 from ASEr import logme     # Logging functions
 from ASEr import run       # File handling functions
 from ASEr import cluster   # Queue submission
-from ASEr.snps import chrom_to_num  # Chromosome number standardization
+from ASEr.counts import SNPCounts   # Array backed SNP count storage
+from ASEr.counts import write_matrix
+from ASEr.counts import merge_count_files
+from ASEr.counts import pack_hit
+from ASEr.metrics import Metrics, aggregate
+from ASEr.metrics import read_metrics, write_metrics
+from ASEr.snpindex import load_snp_index  # Cached SNP BED arrays
 
 # Logging
 logme.MIN_LEVEL = 'info'  # Switch to 'debug' for more verbose, 'warn' for less
 
+# pysam CIGAR operations
+INS       = 1
+DEL       = 2
+SOFT_CLIP = 4
+HARD_CLIP = 5
+
+# Splits an MD tag into match lengths and single reference bases
+MD_TOKENS = re.compile(r'[0-9]+|\^[A-Z]+|[A-Z]')
+
+# The SNP list shared by all worker processes of a pool, set in each worker
+WORKER_SNPS = None
+
+# Packed SNP hits held as Python integers before moving them to numpy
+HIT_CHUNK = 1 << 20
+
 ###############################################################################
 #                          Command Line Description                           #
 ###############################################################################
@@ -54,17 +83,86 @@ Detailed description of inputs/outputs follows:
 -r/--reads
     A SAM or BAM file containing all of the reads masked to the masked genome. The file
     shound have all duplicates removed and MUST be sorted by read name
-    (i.e. samtools sort -n ).
+    (i.e. samtools sort -n ), except in 'region' mode or with --coordinate (see below).
+    In single mode - reads a SAM or BAM from STDIN, so a filtering step can be piped straight
+    into counting (e.g. samtools view -h -q 10 in.bam | CountSNPASE.py -m single -r - ...).
 
 -m/--mode
-    The script can be run in two modes. In 'single' mode, the entire SNP counting is performed
+    The script can be run in four modes. In 'single' mode, the entire SNP counting is performed
     locally. In 'multi' mode, the read file will be split up by the number of specified jobs on
-    the cluster. This is much faster for large SAM/BAM files.
+    the cluster (without rewriting it, see --shard). This is much faster for large SAM/BAM
+    files. In 'region' mode, the read file must be a coordinate sorted and indexed BAM (i.e.
+    samtools sort; samtools index), each job reads one chromosome or sub-region of the original
+    file directly.
+    In 'batch' mode, -r/--reads takes many files, the SNP BED is read only once, and every
+    file is counted against it, up to --threads at a time. One [PREFIX]_[NAME]_SNP_COUNTS.txt
+    file is written per reads file, or with --matrix a single [PREFIX]_SNP_MATRIX.txt table
+    with two columns (POS_A|C|G|T and NEG_A|C|G|T) per reads file.
+
+--region
+    Only count fragments starting in this region of an indexed BAM, format is chr or
+    chr:start-end (1-based, inclusive). Fragments are assigned to the region holding the
+    leftmost start of their mates, so every fragment is counted in exactly one region.
+    Set automatically by 'region' mode.
+
+--shard
+    Only count the reads between two offsets of the reads file, format is start-end, as
+    returned by tell() (BGZF virtual offsets for BAM), an empty end reads to the end of
+    the file. Set automatically by 'multi' mode, which records the offset at which the
+    read name changes near every 1/jobs of the file. The reads file must be a BAM, or a SAM
+    that is uncompressed or compressed with bgzip (not gzip).
+
+--stream
+    In single mode, count every fragment as soon as the next read name appears, instead of
+    holding the SNPs of every fragment in memory until the end of the file. Peak memory then
+    depends on the largest fragment, not on the size of the file. Requires the file to be
+    sorted by read name. Random choices are made in file order, so with a --random-seed the
+    output is reproducible, but not identical to the default mode.
+
+--metrics
+    Time each phase of the run and write [PREFIX]_metrics.json, with the wall time and reads
+    per second of each phase (load_snps, decode, filter, md_parse, assignment and output),
+    the skip counters and the peak memory (max_rss_mb) of the process. A progress line is
+    logged every 30 seconds. In multi and region mode every job writes its own metrics and
+    [PREFIX]_metrics.json holds their sums, the wall time of the whole run and the metrics of
+    every job, which can be used to choose --jobs, --walltime and --mem. Not used in batch
+    mode.
+
+-H/--hash-choice
+    Choose the SNP of every fragment overlapping more than one SNP from a hash of its read
+    name and --random-seed, instead of from the randomizer. The choice no longer depends on
+    the order fragments are counted in, so single, multi and region mode (with any --jobs or
+    --threads), --stream and --coordinate all give byte-identical counts, without sorting
+    every read name. The counts differ from those of the randomizer with the same seed.
+
+--io-threads
+    Decompress BAM blocks in this many htslib threads instead of in the counting process,
+    in single mode, in the scan that cuts 'multi' mode into shards, and in every job or
+    process. Each job is given this many cores on the cluster, without a cluster up to
+    --threads x --io-threads threads run at once. 'multi' mode and --shard only take more
+    than one with a BAM, as the threaded SAM reader reads ahead of the offsets they record.
+
+--contigs
+    Only load the SNPs of these contigs, so memory use scales with the contigs a job counts
+    rather than the whole genome. By default single mode loads only the contigs with mapped
+    reads in the BAM index (or in the header if there is no index), which never changes the
+    counts. A --region job (i.e. every job of 'region' mode) loads the contig of its region,
+    and the SNPs of any other contig the first time a distant mate is found on it. With an
+    explicit list, reads on any other contig are not counted.
+
+--coordinate
+    Count a coordinate sorted file (i.e. the output of samtools sort) directly, so the extra
+    name sort of every sample is not needed. Mates are matched up with a small buffer that
+    only holds fragments whose mate has not been reached yet, so memory stays bounded by
+    the insert size, not the file size. Region mode always uses this. Secondary and
+    supplementary alignments are not counted, as their mates cannot be matched up by
+    position (name sorted modes count them as part of their fragment).
 
 OUTPUT:
 
 The output of the script is a tab-delimited text file, [PREFIX]_SNP_COUNTS.txt, which contains the
-following columns:
+following columns (with --npz the same rows are written as arrays to [PREFIX]_SNP_COUNTS.npz,
+see ASEr.counts):
 
 CHR\t\tChromosome where SNP is found
 POSITION\t1-based position of SNP
@@ -103,114 +201,675 @@ def fasta_to_dict(file):
     return fasta_dict
 
 
-def split_CIGAR(cigar):
-    """Split the CIGAR string and return two lists: types and values."""
-    cig_types_tmp = re.split('[0-9]', cigar)
-    cig_vals_tmp = re.split('[MIDNSHP\=X]', cigar)
-    cig_types = []
-    cig_vals = []
+def read_snps(line, references, snps, stats):
+    """Return the target SNPs overlapped by a single read.
 
-    for i in cig_types_tmp:
-        if i != '':
-            cig_types.append(i)
+    Reads that overlap insertions/deletions, or whose span does not include
+    any target SNP, are skipped. Masked positions are found from the 'N'
+    reference bases in the MD tag, and are placed on the genome with the
+    aligned blocks of the read.
+
+    :line:       A pysam AlignedSegment.
+    :references: The reference names of the Samfile.
+    :snps:       A SNPCounts object of the target SNPs.
+    :stats:      A dictionary of skip counters, updated in place.
+    :returns:    A list of (snp_ordinal, allele, strand) tuples.
+    """
+    # Skip lines that overlap indels OR don't match Ns
+    cigar = line.cigartuples
+    if not cigar:
+        return []
+    for op, length in cigar:
+        if op == INS or op == DEL:
+            stats['indel_skip'] += 1
+            return []
+
+    # Most reads do not cover any target SNP, drop them before the tags and
+    # sequence are decoded.
+    chrom = references[line.reference_id]
+    if not snps.overlaps(chrom, line.reference_start, line.reference_end):
+        stats['nooverlap_skip'] += 1
+        return []
+
+    if not line.has_tag('MD'):
+        return []
+    md = line.get_tag('MD')
+    if 'N' not in md:
+        return []
+
+    # Offsets of the masked bases among the aligned bases of the read
+    offsets = []
+    offset  = 0
+    for token in MD_TOKENS.findall(md):
+        if token.isdigit():
+            offset += int(token)
+        else:
+            if token == 'N':
+                offsets.append(offset)
+            offset += 1
+
+    # Without indels, aligned bases are contiguous in the read, after any
+    # clipping at the start.
+    query_start = 0
+    for op, length in cigar:
+        if op == SOFT_CLIP:
+            query_start += length
+        elif op != HARD_CLIP:
+            break
+
+    # We're assuming
+    # correct mapping such that FIRST MATES on the NEGATIVE
+    # STRAND are NEGATIVE, while SECOND MATES on the NEGATIVE
+    # STRAND are POSITIVE.
+    orientation = '-' if line.is_reverse else '+'
+    read   = line.query_sequence
+    blocks = line.get_blocks()
+
+    found       = []
+    block       = 0
+    block_first = 0  # Offset of the first base of the current block
+    for offset in offsets:
+        while offset - block_first >= blocks[block][1] - blocks[block][0]:
+            block_first += blocks[block][1] - blocks[block][0]
+            block       += 1
+        stats['snp_count'] += 1
+
+        # RYO: START EDIT - Implemented Filter
+        ordinal = snps.ordinal(chrom, blocks[block][0] + offset -
+                               block_first + 1)
+        if ordinal < 0:
+            stats['nosnp_skip'] += 1
+            continue
+        # RYO: END EDIT - Implmented Filter
+
+        found.append((ordinal, read[query_start + offset], orientation))
+
+    return found
+
+
+def count_coordinate_sorted(reads, references, snps, stats, choose):
+    """Count reads from a coordinate sorted file without name sorting.
+
+    Reads are taken in coordinate order and each is reduced to its target SNP
+    hits straight away. Hits of a read whose mate starts further on are held
+    in a buffer until the mate arrives, then one SNP is chosen at random for
+    the whole fragment. As the mate position of every read is known, any
+    fragment whose mate position has been passed is resolved too, so the
+    buffer only ever holds fragments that span the current position.
+    Secondary and supplementary alignments are skipped, as they would be
+    counted as extra fragments once the primary mates are resolved.
+
+    :reads:      An iterable of reads sorted by coordinate.
+    :references: The reference names of the Samfile.
+    :snps:       A SNPCounts object, counts are added to it.
+    :stats:      A dictionary of skip counters, updated in place.
+    :choose:     A function of (hits, qname) that picks one SNP hit.
+    :returns:    The number of reads processed.
+    """
+    pending = {}  # qname => SNP hits of the mates seen so far
+    waiting = []  # heap of (mate_tid, mate_start, qname) for pending
+
+    count = 0
+    for line in reads:
+        count += 1
+        here  = (line.reference_id, line.reference_start)
+
+        # Resolve fragments whose mate should have been seen already
+        while waiting and waiting[0][:2] < here:
+            qname = heappop(waiting)[2]
+            if qname in pending:
+                snps.add(*choose(pending.pop(qname), qname))
+
+        # A secondary or supplementary alignment arriving before the mate
+        # would resolve the fragment early, and after it would count again
+        if line.is_secondary or line.is_supplementary:
+            stats['secondary_skip'] += 1
+            continue
+
+        hits  = read_snps(line, references, snps, stats)
+        qname = line.query_name
+        if qname in pending:
+            fragment = pending.pop(qname)
+            for snp in hits:
+                if snp not in fragment:
+                    fragment.append(snp)
+                else:
+                    stats['ryo_filter'] += 1
+            hits = fragment
+        elif hits and line.is_paired and not line.mate_is_unmapped:
+            mate = (line.next_reference_id, line.next_reference_start)
+            if mate >= here:
+                pending[qname] = hits
+                heappush(waiting, mate + (qname,))
+                continue
+        if hits:
+            snps.add(*choose(hits, qname))
 
-    for i in cig_vals_tmp:
-        if i != '':
-            cig_vals.append(i)
+    # Mates that never turned up, e.g. outside of the region counted
+    for qname in sorted(pending):
+        snps.add(*choose(pending[qname], qname))
 
-    return cig_types, cig_vals
+    return count
 
 
-def CIGAR_to_Genomic_Positions(cigar_types, cigar_vals, pos):
-    """Use the CIGAR string to return a list of genomic coordinates.
+def fragment_key(qname, seed=0):
+    """Return a 64-bit key for a read name.
 
-    Coordinates correspond to the individual bases of the read to get SNP
-    positions from the MD tag.
+    The upper 32 bits are the same hash hashed_choice() uses, the lower 32
+    bits come from an md5 of the name, which is independent of the CRC and
+    well spread even for short, similar read names, to keep fragments apart.
     """
-    # Initialize the list of genomic positions
-    genomic_positions = []
-    curr_pos = pos
-
-    for i in range(len(cigar_types)):
-        # What are we going to do to each CIGAR str.
-        if cigar_types[i] == 'N':
-            curr_pos = int(curr_pos) + int(cigar_vals[i])
-        elif cigar_types[i] == 'D':
-            curr_pos = int(curr_pos) + int(cigar_vals[i])
-        elif cigar_types[i] == 'M':
-            genomic_positions = genomic_positions + list(range(int(curr_pos),
-                                                               int(curr_pos)+int(cigar_vals[i])))
-            curr_pos = int(curr_pos) + int(cigar_vals[i])
-    return genomic_positions
-
-
-def count_reads(samfilename):
-    """Return the number of reads in a samfile.
-
-    Use built-in counts if possible, but fall back to looping through otherwise
+    name = qname.encode()
+    return ((zlib.crc32(name, seed) & 0xffffffff) << 32 |
+            struct.unpack('<I', hashlib.md5(name).digest()[:4])[0])
+
+
+def choose_packed(keys, hits, snps, stats, hashed=False):
+    """Choose one SNP hit of every fragment and add it to snps.
+
+    :keys:   A uint64 array of fragment_key() of every SNP hit.
+    :hits:   An int64 array of pack_hit() of every SNP hit.
+    :stats:  A dictionary of skip counters, ryo_filter is updated in place.
+    :hashed: Choose the same hit as hashed_choice() would, instead of at
+             random.
     """
-    sf = Samfile(samfilename)
-    try:
-        return sf.mapped
-    except ValueError:
-        num_reads = 0
-        for num_reads, _ in enumerate(sf):
-            pass
-    return num_reads
-
-
-def split_samfile(sam_file, splits, prefix='', path=''):
-    """Take a sam file and split it splits number of times.
-
-    :path:    Where to put the split files.
-    :prefix:  A prefix for the outfile names.
-    :returns: A tuple of job files.
+    if not len(keys):
+        return
+    order = np.lexsort((hits, keys))
+    keys  = keys[order]
+    hits  = hits[order]
+
+    # Both mates of a pair can overlap the same SNP, only count it once
+    same = (keys[1:] == keys[:-1]) & (hits[1:] == hits[:-1])
+    stats['ryo_filter'] += int(same.sum())
+    keep = np.concatenate([[True], ~same])
+    keys = keys[keep]
+    hits = hits[keep]
+
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+    sizes  = np.diff(np.append(starts, len(keys)))
+    if hashed:
+        picks = (keys[starts] >> np.uint64(32)) % sizes.astype(np.uint64)
+    else:
+        picks = np.random.randint(0, sizes)
+    snps.add_packed(hits[starts + picks.astype(np.int64)])
+
+
+def hashed_choice(hits, qname, seed=0):
+    """Choose one SNP hit of a fragment from a hash of its read name.
+
+    The choice only depends on the read name, the seed and the set of hits,
+    not on how many fragments were counted before, so any shard, region or
+    process makes the same choice for a fragment as a single run does.
     """
-    # Determine how many reads will be in each split sam file.
-    num_lines = count_reads(sam_file)
-    num_reads = int(int(num_lines)/splits) + 1
-
-    # Get rid of starting path
-    sam_name = os.path.basename(sam_file)
-
-    # Subset the SAM file into X number of jobs
-    cnt      = 0
-    currjob  = 1
-    suffix   = '.split_sam_' + str(currjob).zfill(4)
-    run_file = os.path.join(path, prefix + sam_name + suffix)
-    rmode    = 'rb' if sam_name.split('.')[0] == 'bam' else 'r'
-    wmode    = 'wb'
-
-    # Actually split the file
-    outfiles = [run_file]
-    with Samfile(sam_file, rmode) as in_sam:
-        sam_split = Samfile(run_file, wmode, template=in_sam)
-        for line in in_sam:
-            cnt += 1
-            if cnt < num_reads:
-                sam_split.write(line)
-            elif cnt == num_reads:
-                # Check if next line is mate-pair. If so, don't split.
-                line2     = next(in_sam)
-                currjob  += 1
-                suffix    = '.split_sam_' + str(currjob).zfill(4)
-                run_file  = os.path.join(path, prefix + sam_name + suffix)
-                new_sam   = Samfile(run_file, wmode, template=in_sam)
-                outfiles.append(run_file)
-
-                if line.qname == line2.qname:
-                    sam_split.write(line)
-                    sam_split.write(line2)
-                    sam_split.close()
-                    cnt = 0
+    if len(hits) == 1:
+        return hits[0]
+    hits = sorted(hits)
+    return hits[(zlib.crc32(qname.encode(), seed) & 0xffffffff) % len(hits)]
+
+
+def timed_reads(reads, stats, metrics):
+    """Yield reads, timing how long each takes to decode and to process.
+
+    The time the caller spends on a read, until it asks for the next one, is
+    added to 'filter' if read_snps() dropped the read before parsing its tags,
+    or to 'md_parse' if it did not, which includes storing its SNP hits. With
+    --stream reads are taken a little ahead, so the split is only approximate.
+
+    :reads:   An iterable of reads.
+    :stats:   The skip counters updated by read_snps().
+    :metrics: A Metrics object.
+    """
+    last = time()
+    for count, read in enumerate(reads):
+        now = time()
+        metrics.add('decode', now - last)
+        skipped = (stats['secondary_skip'] + stats['indel_skip'] +
+                   stats['nooverlap_skip'])
+        yield read
+        last = time()
+        if (stats['secondary_skip'] + stats['indel_skip'] +
+                stats['nooverlap_skip']) > skipped:
+            metrics.add('filter', last - now)
+        else:
+            metrics.add('md_parse', last - now)
+        if not count % 10000:
+            metrics.progress(count)
+
+
+def count_snps(reads_file, snps, mode='rb', region=None, shard=None,
+               stream=False, coordinate=False, random_seed=None,
+               hash_seed=None, metrics=None, io_threads=1):
+    """Count the reads of one SAM/BAM file at every target SNP.
+
+    One SNP is chosen at random for every fragment (read name) that overlaps
+    any target SNP, and the read base at that SNP is added to snps.
+
+    :reads_file:  A SAM or BAM file, sorted by read name unless coordinate.
+    :snps:        A SNPCounts object, counts are added to it.
+    :mode:        The mode to open reads_file with ('r' or 'rb').
+    :region:      Only count fragments starting in this region.
+    :shard:       Only count the reads of this shard, see get_shards().
+    :stream:      Count each fragment as soon as the next read name appears.
+    :coordinate:  reads_file is sorted by coordinate.
+    :random_seed: Reseed the randomizer with this before counting.
+    :hash_seed:   Choose SNPs with hashed_choice() and this seed instead of
+                  the randomizer, so the counts do not depend on read order.
+    :metrics:     A Metrics object to add phase timings and counters to.
+    :io_threads:  Threads htslib uses to decompress a BAM.
+    :returns:     A dictionary of read and skip counters.
+    """
+    # This is the dictionary of potential SNPs for each read.
+    potsnp_dict = {}
+
+    # Reseed, so every file counted in a process gets the same choices as it
+    # would when counted on its own.
+    if random_seed is not None:
+        random.seed(random_seed)
+
+    if hash_seed is None:
+        def choose(hits, qname):
+            return random.choice(hits)
+    else:
+        def choose(hits, qname):
+            return hashed_choice(hits, qname, hash_seed)
+
+    # Now parse the SAM file to extract only reads overlapping SNPs.
+    sam_file   = os.path.basename(reads_file)
+    in_sam     = Samfile(reads_file, mode, threads=io_threads)
+    references = in_sam.references  # Faster to make a copy of references.
+    if region:
+        reads = region_reads(in_sam, region)
+    elif shard:
+        reads = shard_reads(in_sam, shard)
+    else:
+        reads = in_sam
+
+    # Trackers to count how many reads are lost at each step
+    count = 0
+    stats = {'secondary_skip': 0, 'indel_skip': 0, 'nooverlap_skip': 0,
+             'nosnp_skip': 0, 'snp_count': 0, 'ryo_filter': 0}
+
+    if metrics is not None:
+        reads = timed_reads(reads, stats, metrics)
+
+    if coordinate:
+        if in_sam.header.get('HD', {}).get('SO') != 'coordinate':
+            logme.log('{} is not marked as sorted by '.format(sam_file) +
+                      'coordinate, counts will be wrong if it is not.',
+                      'warn')
+        count = count_coordinate_sorted(reads, references, snps, stats,
+                                        choose)
+
+    elif stream:
+        # Reads are name sorted, so each fragment can be resolved as soon
+        # as the next read name appears.
+        if in_sam.header.get('HD', {}).get('SO') != 'queryname':
+            logme.log('{} is not marked as sorted by '.format(sam_file) +
+                      'read name, streaming counts will be wrong ' +
+                      'if mates are not adjacent.', 'warn')
+        for qname, fragment_reads in groupby(reads,
+                                             attrgetter('query_name')):
+            fragment = []
+            for line in fragment_reads:
+                count += 1
+                for snp in read_snps(line, references, snps, stats):
+                    if snp not in fragment:
+                        fragment.append(snp)
+                    else:
+                        stats['ryo_filter'] += 1
+            if fragment:
+                snps.add(*choose(fragment, qname))
+
+    elif random_seed is None or hash_seed is not None:
+        # No random sequence needs to be reproduced, so fragments are kept
+        # as a 64-bit key of their name, and each SNP hit as one integer,
+        # in chunks of numpy arrays instead of a dictionary of lists.
+        keys       = []
+        hits       = []
+        key_chunks = []
+        hit_chunks = []
+        seed = hash_seed if hash_seed is not None else 0
+        for line in reads:
+            count += 1
+            read_hits = read_snps(line, references, snps, stats)
+            if read_hits:
+                key = fragment_key(line.query_name, seed)
+                for snp in read_hits:
+                    keys.append(key)
+                    hits.append(pack_hit(*snp))
+                if len(keys) >= HIT_CHUNK:
+                    key_chunks.append(np.array(keys, dtype=np.uint64))
+                    hit_chunks.append(np.array(hits, dtype=np.int64))
+                    keys = []
+                    hits = []
+        key_chunks.append(np.array(keys, dtype=np.uint64))
+        hit_chunks.append(np.array(hits, dtype=np.int64))
+        start = time()
+        choose_packed(np.concatenate(key_chunks), np.concatenate(hit_chunks),
+                      snps, stats, hashed=hash_seed is not None)
+        if metrics is not None:
+            metrics.add('assignment', time() - start)
+
+    else:
+        for line in reads:
+            count += 1
+            for snp in read_snps(line, references, snps, stats):
+                if line.qname in potsnp_dict:
+                    if snp not in potsnp_dict[line.qname]:
+                        # RYO EDIT HERE - added conditional so that pairs
+                        # of reads are not considered twice if they both
+                        # overlap the same snp.
+                        potsnp_dict[line.qname].append(snp)
+                    else:
+                        stats['ryo_filter'] += 1
                 else:
-                    sam_split.write(line)
-                    sam_split.close()
-                    new_sam.write(line2)
-                    cnt = 0
-                sam_split = new_sam
-        sam_split.close()
-    return tuple(outfiles)
+                    potsnp_dict[line.qname] = []
+                    potsnp_dict[line.qname].append(snp)
+
+    in_sam.close()
+
+    # Log all of the skipped reads
+    logme.log('Total reads: {}'.format(count), 'debug')
+    logme.log('Secondary and supplementary reads skipped: {}'.format(
+        stats['secondary_skip']), 'debug')
+    logme.log('Reads skipped for indels: {}'.format(stats['indel_skip']),
+              'debug')
+    logme.log('Reads not overlapping any SNP: {}'.format(
+        stats['nooverlap_skip']), 'debug')
+    logme.log('Total SNPs checked: {}'.format(stats['snp_count']),
+              'debug')
+    logme.log('SNPs not in SNP list: {}'.format(stats['nosnp_skip']),
+              'debug')
+    logme.log('Ryo filter: {}'.format(stats['ryo_filter']), 'debug')
+
+    # Go through the potential SNP dictionary and choose one SNP at random
+    # for those overlapping multiple SNPs
+    start = time()
+    if random_seed is not None and hash_seed is None:  # Dictionaries are unordered, so must sort for consistent random seed output.
+        keys = sorted(list(potsnp_dict.keys()))
+    else:  # Because sorting is slow, only do it if random seed is set, slowdown is about 0.1s per 1 million reads..
+        keys = list(potsnp_dict.keys())
+    for key in keys:
+        snps.add(*choose(potsnp_dict[key], key))
+
+    if metrics is not None:
+        metrics.add('assignment', time() - start)
+        metrics.reads += count
+        metrics.count(stats)
+
+    stats['reads'] = count
+    return stats
+
+
+def sample_name(reads_file):
+    """Return the name of a reads file without its path and extension."""
+    name = os.path.basename(reads_file)
+    if name.split('.')[-1].lower() in ['bam', 'sam']:
+        name = name.rsplit('.', 1)[0]
+    return name
+
+
+def _init_worker(snps):
+    """Set the SNP list used by _count_batch_file and _count_piece.
+
+    numpy's randomizer is reseeded, as forked workers would otherwise all
+    draw the same stream in choose_packed().
+    """
+    global WORKER_SNPS
+    WORKER_SNPS = snps
+    np.random.seed((os.getpid() + int(time()*1000000)) & 0xffffffff)
+
+
+def _count_batch_file(job):
+    """Count one file of a batch against the shared SNP list.
+
+    :job:     A tuple of (reads_file, mode, outfile, binary, stream,
+              coordinate, random_seed, hash_seed, io_threads, profile), if
+              outfile is None the counts are returned instead of written,
+              profile is the file to write a cProfile dump to, or None.
+    :returns: None, or (sample_name, ordinals, counts) of the seen SNPs.
+    """
+    (reads_file, mode, outfile, binary, stream, coordinate, random_seed,
+     hash_seed, io_threads, profile) = job
+    logme.log('Counting {}'.format(reads_file))
+    snps = WORKER_SNPS.empty_like()
+    run.profile_call(profile, count_snps, reads_file, snps, mode,
+                     stream=stream, coordinate=coordinate,
+                     random_seed=random_seed, hash_seed=hash_seed,
+                     io_threads=io_threads)
+    if outfile:
+        snps.write(outfile, binary=binary)
+        return None
+    ordinals, counts = snps.sparse()
+    return sample_name(reads_file), ordinals, counts
+
+
+def _count_piece(job):
+    """Count one region or shard of a reads file against the shared SNPs.
+
+    :job:     A tuple of (reads_file, mode, region, shard, coordinate,
+              random_seed, hash_seed, io_threads, name, profile), name is
+              the name of the metrics to collect, or None, profile is the
+              file to write a cProfile dump to, or None.
+    :returns: (ordinals, counts, metrics) of the seen SNPs, metrics is a
+              dictionary or None.
+    """
+    (reads_file, mode, region, shard, coordinate, random_seed, hash_seed,
+     io_threads, name, profile) = job
+    metrics = Metrics(name) if name else None
+    snps    = WORKER_SNPS.empty_like()
+    run.profile_call(profile, count_snps, reads_file, snps, mode,
+                     region=region, shard=shard, coordinate=coordinate,
+                     random_seed=random_seed, hash_seed=hash_seed,
+                     metrics=metrics, io_threads=io_threads)
+    ordinals, counts = snps.sparse()
+    return ordinals, counts, metrics.as_dict() if metrics else None
+
+
+def count_pieces(reads_file, snps, pieces, mode='rb', coordinate=False,
+                 threads=1, random_seed=None, hash_seed=None, metrics=None,
+                 profile=None, io_threads=1):
+    """Count many pieces of one reads file in a pool of processes.
+
+    Every process gets a copy of the SNP list when it starts, and returns
+    only the counts of the SNPs it saw, so nothing is written to disk.
+
+    :snps:    A SNPCounts object, the counts of all pieces are added to it.
+    :pieces:  A list of (region, shard) tuples, one of the two is None.
+    :threads: The number of processes to run at a time.
+    :io_threads: Threads each process uses to decompress a BAM.
+    :metrics: A name, if given the metrics of every piece are collected, as
+              name_0001, name_0002...
+    :profile: A file name, if given each piece counted in its own process
+              writes a cProfile dump to profile.0001, profile.0002... (see
+              run.profile_name()), without a pool the caller profiles it.
+    :returns: A list of the metrics dictionaries of all pieces.
+    """
+    threads = min(threads, len(pieces))
+    jobs    = []
+    for i, (region, shard) in enumerate(pieces):
+        suffix = str(i+1).zfill(4)
+        name   = metrics + '_' + suffix if metrics else None
+        jobs.append((reads_file, mode, region, shard, coordinate,
+                     random_seed, hash_seed, io_threads, name,
+                     run.profile_name(profile, suffix)
+                     if profile and threads > 1 else None))
+    if threads > 1:
+        pool    = Pool(threads, _init_worker, (snps,))
+        results = pool.imap_unordered(_count_piece, jobs)
+    else:
+        _init_worker(snps)
+        results = (_count_piece(job) for job in jobs)
+
+    workers = []
+    for ordinals, counts, piece_metrics in results:
+        snps.add_sparse(ordinals, counts)
+        if piece_metrics:
+            workers.append(piece_metrics)
+
+    if threads > 1:
+        pool.close()
+        pool.join()
+    return sorted(workers, key=lambda i: i['name'])
+
+
+def get_shards(sam_file, splits, mode='rb', io_threads=1):
+    """Divide a name sorted SAM/BAM into about splits pieces of similar size.
+
+    The file is not rewritten, instead the offset of the first read of every
+    piece is recorded (a BGZF virtual offset for BAM), and each job seeks
+    straight to its piece of the original file. Pieces are only cut where the
+    read name changes, so mates always stay in the same piece.
+
+    :io_threads: Threads htslib uses to decompress a BAM.
+    :returns: A tuple of shard strings of the form 'start-end', the end of
+              the last one is empty (read to the end of the file).
+    """
+    with Samfile(sam_file, mode, threads=io_threads) as in_sam:
+        # A virtual offset holds the offset of its compressed block in the
+        # upper 48 bits, that is what the file size is split on.
+        shift  = 16 if in_sam.compression == 'BGZF' else 0
+        first  = in_sam.tell()
+        step   = float(os.path.getsize(sam_file) - (first >> shift))/splits
+        target = (first >> shift) + step
+        starts = [first]
+        last   = None
+        while True:
+            offset = in_sam.tell()
+            try:
+                read = next(in_sam)
+            except StopIteration:
+                break
+            if (offset >> shift) >= target and read.query_name != last:
+                starts.append(offset)
+                while target <= (offset >> shift):
+                    target += step
+            last = read.query_name
+
+    ends = [str(i) for i in starts[1:]] + ['']
+    return tuple(['{}-{}'.format(i, j) for i, j in zip(starts, ends)])
+
+
+def shard_reads(in_sam, shard):
+    """Yield all reads of one shard of an open Samfile, see get_shards()."""
+    start, end = shard.split('-')
+    end        = int(end) if end else None
+    in_sam.seek(int(start))
+    while end is None or in_sam.tell() < end:
+        try:
+            yield next(in_sam)
+        except StopIteration:
+            return
+
+
+def parse_region(region):
+    """Split a samtools style region string into its parts.
+
+    :region:  A string of the form 'chr' or 'chr:start-end' (1-based,
+              inclusive, commas allowed).
+    :returns: A tuple of (chrom, start, end), start and end are 0-based and
+              half-open, both are None if region is a whole chromosome.
+    """
+    match = re.match(r'^(.+):([0-9,]+)-([0-9,]+)$', region)
+    if not match:
+        return region, None, None
+    chrom, start, end = match.groups()
+    return (chrom, int(start.replace(',', '')) - 1,
+            int(end.replace(',', '')))
+
+
+def get_regions(sam_file, splits):
+    """Divide an indexed BAM into about splits regions of similar size.
+
+    Each chromosome with mapped reads gets a share of the splits proportional
+    to its number of mapped reads, and is then cut into equal length pieces.
+
+    :returns: A tuple of region strings of the form 'chr:start-end'.
+    """
+    with Samfile(sam_file, 'rb') as in_sam:
+        if not in_sam.has_index():
+            raise Exception('{} has no index, region mode needs a '.format(
+                sam_file) + 'coordinate sorted and indexed BAM')
+        stats   = [(i.contig, i.mapped) for i in
+                   in_sam.get_index_statistics() if i.mapped]
+        lengths = dict(zip(in_sam.references, in_sam.lengths))
+
+    total   = float(sum([i[1] for i in stats]))
+    regions = []
+    for chrom, mapped in stats:
+        pieces = max(1, int(round(splits*mapped/total)))
+        length = lengths[chrom]
+        step   = int(length/pieces) + 1
+        for start in range(0, length, step):
+            regions.append('{}:{}-{}'.format(chrom, start+1,
+                                             min(start+step, length)))
+    return tuple(regions)
+
+
+def get_contigs(sam_file, mode='rb'):
+    """Return the contigs that can hold mapped reads of a SAM/BAM.
+
+    These are the contigs with mapped reads in the index of a BAM, or all
+    contigs of the header if there is no index.
+    """
+    with Samfile(sam_file, mode) as in_sam:
+        if in_sam.is_bam and in_sam.has_index():
+            return [i.contig for i in in_sam.get_index_statistics()
+                    if i.mapped]
+        return list(in_sam.references)
+
+
+def region_reads(in_sam, region):
+    """Yield all reads of fragments that start in region.
+
+    A fragment is owned by the region holding the leftmost start of its
+    mates, so a pair split across two regions (or two chromosomes) is only
+    ever seen by one worker, and the one SNP per fragment rule still holds.
+    Secondary and supplementary alignments are never yielded, as they would
+    be counted as extra fragments.
+
+    :in_sam:  An open, indexed, coordinate sorted Samfile.
+    :region:  A region string, see parse_region().
+    """
+    chrom, start, end = parse_region(region)
+    tid    = in_sam.get_tid(chrom)
+    length = in_sam.get_reference_length(chrom)
+    start  = start if start else 0
+    end    = end if end else length
+
+    # Keep reading past the end of the region until all mates on this
+    # chromosome have been found, mates on other chromosomes are fetched last.
+    horizon = end
+    distant = []
+    for read in in_sam.fetch(chrom, start, length):
+        rstart = read.reference_start
+        if rstart >= horizon:
+            break
+        if rstart < start or read.is_secondary or read.is_supplementary:
+            continue
+        if read.is_paired and not read.mate_is_unmapped:
+            mate = (read.next_reference_id, read.next_reference_start)
+        else:
+            mate = None
+        leftmost = min((tid, rstart), mate) if mate else (tid, rstart)
+        if not (tid, start) <= leftmost < (tid, end):
+            continue
+        if mate and rstart < end and mate > (tid, rstart):
+            if mate[0] == tid:
+                horizon = max(horizon, mate[1]+1)
+            else:
+                distant.append((mate, read.query_name))
+        yield read
+
+    # Mates must come in coordinate order, or count_coordinate_sorted()
+    # resolves a fragment before its mate arrives and counts the mate again
+    references = in_sam.references
+    for (mtid, mstart), qname in sorted(distant):
+        for read in in_sam.fetch(references[mtid], mstart, mstart+1):
+            if (read.reference_start == mstart and read.query_name == qname
+                    and not read.is_secondary and not read.is_supplementary):
+                yield read
 
 
 ###############################################################################
@@ -239,12 +898,13 @@ def main(argv=None):
 
     req = parser.add_argument_group('Required arguments')
     req.add_argument('-m', '--mode',
-                     help='Operation mode', choices=['single', 'multi'],
+                     help='Operation mode', choices=['single', 'multi', 'region', 'batch'],
                      required=True, metavar='mode')
     req.add_argument('-s', '--snps',
                      help='SNP BED file', required=True, metavar='<BED>')
-    req.add_argument('-r', '--reads',
-                     help='Mapped reads file [sam or bam]',
+    req.add_argument('-r', '--reads', nargs='+',
+                     help='Mapped reads file [sam or bam], batch mode ' +
+                     'takes many, - reads STDIN in single mode',
                      required=True, metavar='<[S/B]AM>')
 
     uni = parser.add_argument_group('Universal optional arguments')
@@ -255,12 +915,26 @@ def main(argv=None):
                      help='Mapped read file type is bam (auto-detected if *.bam)')
     uni.add_argument('-n', '--noclean', action='store_true',
                      help='Do not delete intermediate files (for debuging)')
+    uni.add_argument('--npz', action='store_true',
+                     help='Write counts as a binary numpy file, ' +
+                     '[PREFIX]_SNP_COUNTS.npz, instead of text')
     uni.add_argument('-R', '--random-seed', default=None, type=int,
                      help='Set the state of the randomizer (for testing)')
+    uni.add_argument('--metrics', action='store_true',
+                     help='Write phase timings, reads/s and peak memory to ' +
+                     '[PREFIX]_metrics.json (not in batch mode)')
+    uni.add_argument('-H', '--hash-choice', action='store_true',
+                     help='Choose the SNP of each fragment from a hash of ' +
+                     'its read name and the --random-seed (0 if not set), ' +
+                     'counts are then the same for any --jobs or --threads')
+    uni.add_argument('--io-threads', type=int, default=1, metavar='',
+                     help='Threads used to decompress a BAM, in every job ' +
+                     'or process')
+    run.add_profile_argument(uni)
     uni.add_argument('-h', '--help', action='help',
                      help='show this help message and exit')
 
-    mult = parser.add_argument_group('Multi(plex) mode arguments')
+    mult = parser.add_argument_group('Multi(plex) and region mode arguments')
     mult.add_argument('-j', '--jobs', type=int,
                       help='Divide into # of jobs', default=100, metavar='')
     if cluster_type == 'slurm' or cluster_type == 'torque':
@@ -276,12 +950,39 @@ def main(argv=None):
                           help='Which cluster to use, normal uses threads ' +
                           'on this machine', default=cluster_type)
     mult.add_argument('--threads', type=int, metavar='', default=cpu_count(),
-                      help='Max number of threads to run at a time ' +
-                      '(normal mode only).')
+                      help='Max number of processes to run at a time ' +
+                      '(batch mode, and multi and region mode without a ' +
+                      'cluster).')
 
     single = parser.add_argument_group('Single mode arguments')
     single.add_argument('-f', '--suffix', default='', metavar='',
                         help='Suffix for multiplexing [set automatically]')
+    single.add_argument('--region', metavar='',
+                        help='Only count fragments starting in this region ' +
+                        'of an indexed BAM [set automatically]')
+    single.add_argument('--shard', metavar='',
+                        help='Only count the reads between these two file ' +
+                        'offsets, start-end [set automatically]')
+    single.add_argument('--stream', action='store_true',
+                        help='Count each fragment as soon as its reads are ' +
+                        'read, memory use no longer grows with the file ' +
+                        'size (needs a name sorted file)')
+    single.add_argument('--contigs', metavar='',
+                        help='Only load the SNPs of these contigs (comma ' +
+                        'separated), reads on other contigs are not ' +
+                        'counted [default: the contigs with reads in the ' +
+                        'BAM index or header, or with --region the contig ' +
+                        'of the region and those of any distant mates]')
+    single.add_argument('--coordinate', action='store_true',
+                        help='The file is sorted by coordinate, count it ' +
+                        'directly without name sorting [set automatically ' +
+                        'in region mode]')
+
+    batch = parser.add_argument_group('Batch mode arguments')
+    batch.add_argument('--matrix', action='store_true',
+                       help='Write one SNPs x samples table, ' +
+                       '[PREFIX]_SNP_MATRIX.txt, instead of a SNP_COUNTS ' +
+                       'file per reads file')
 
     logging = parser.add_argument_group('Logging options')
     logging.add_argument('-q', '--quiet', action='store_true',
@@ -293,6 +994,20 @@ def main(argv=None):
                          'STDERR')
 
     args = parser.parse_args()
+
+    # STDIN can only be read once, from start to end
+    if '-' in args.reads and (args.mode != 'single' or args.region or
+                              args.shard):
+        parser.error('reads can only be read from STDIN (-) in single ' +
+                     'mode, without --region or --shard')
+
+    # Only batch mode takes more than one reads file
+    if args.mode == 'batch':
+        reads_files = args.reads
+    elif len(args.reads) > 1:
+        parser.error('only batch mode takes more than one reads file')
+    args.reads = args.reads[0]
+
     if args.random_seed is not None:
         random.seed(args.random_seed)
         print("Seed: ", args.random_seed, random.getstate()[1][:10])
@@ -311,58 +1026,134 @@ def main(argv=None):
 
     # Initialize variables
     prefix = args.prefix + '_'
+    ext    = '.npz' if args.npz else '.txt'
+    if args.hash_choice:
+        hash_seed = args.random_seed if args.random_seed is not None else 0
+    else:
+        hash_seed = None
 
     # Make sure we can run ourselves
     if not run.is_exe(program_name):
         program_name = run.which(parser.prog)
 
-    # Set the cluster type if we are in multi mode
-    if args.mode == 'multi' and (cluster_type == 'slurm'
-                                 or cluster_type == 'torque'):
+    # Set the cluster type if we are in multi or region mode
+    if args.mode in ['multi', 'region'] and (cluster_type == 'slurm'
+                                             or cluster_type == 'torque'):
         cluster.QUEUE = args.cluster
 
     # Check if the read file is sam or bam
     file_check = args.reads.split('.')
     file_check[-1] = file_check[-1].lower()
-    sam_path, sam_file = os.path.split(args.reads)
+    sam_file = os.path.basename(args.reads)
 
     if args.reads.endswith('bam') or args.bam:
         mode = 'rb'
     else:
         mode = 'r'
 
+    # Shards are file offsets, which cannot be seeked to in a plain gzip file
+    if args.mode == 'multi' or args.shard:
+        with Samfile(args.reads, mode) as in_sam:
+            compression = in_sam.compression
+            is_bam      = in_sam.is_bam
+        if compression not in ['BGZF', 'NONE']:
+            parser.error('multi mode and --shard need a BAM, or a SAM that ' +
+                         'is uncompressed or compressed with bgzip, ' +
+                         '{} is {} compressed'.format(args.reads,
+                                                      compression))
+        # The threaded SAM parser reads ahead, so tell() is wrong
+        if not is_bam and args.io_threads > 1:
+            parser.error('multi mode and --shard can only use --io-threads ' +
+                         'with a BAM, {} is a SAM'.format(args.reads))
+
     ##################
     # MULTIPLEX MODE #
     ##################
 
-    # If we're running in multiplex mode
-    if args.mode == 'multi':
-        logme.log('Splitting sam file {} into {} files.'.format(sam_file,
-                                                                args.jobs))
-        reads_files = split_samfile(os.path.join(sam_path, sam_file),
-                                    args.jobs, prefix)
-        logme.log('Splitting complete.')
+    # If we're running in multiplex or region mode
+    if args.mode == 'multi' or args.mode == 'region':
+        if args.mode == 'multi':
+            logme.log('Splitting sam file {} into {} pieces.'.format(
+                sam_file, args.jobs))
+            shards   = get_shards(args.reads, args.jobs, mode,
+                                  io_threads=args.io_threads)
+            logme.log('Splitting complete.')
+            filetype = ' --bam' if mode == 'rb' else ''
+            job_args = [' --reads ' + args.reads + ' --shard ' + i + filetype
+                        for i in shards]
+            pieces   = [(None, i) for i in shards]
+        else:
+            regions  = get_regions(args.reads, args.jobs)
+            logme.log('Counting {} in {} regions.'.format(sam_file,
+                                                          len(regions)))
+            job_args = [' --reads ' + args.reads + ' --region ' + i +
+                        ' --coordinate --bam' for i in regions]
+            pieces   = [(i, None) for i in regions]
+
+        # Without a cluster, count the pieces in a pool of processes on this
+        # machine, their counts come straight back as arrays.
+        if cluster.QUEUE not in ['slurm', 'torque']:
+            logme.log('Counting {} pieces with {} processes.'.format(
+                len(pieces), min(args.threads, len(pieces))))
+            metrics = Metrics(args.prefix)
+            start   = time()
+            snps    = SNPCounts.from_bed(args.snps,
+                                         get_contigs(args.reads, mode))
+            metrics.add('load_snps', time() - start)
+            workers = count_pieces(args.reads, snps, pieces, mode,
+                                   coordinate=args.mode == 'region',
+                                   threads=args.threads,
+                                   random_seed=args.random_seed,
+                                   hash_seed=hash_seed,
+                                   metrics=args.prefix if args.metrics
+                                   else None,
+                                   profile=args.profile,
+                                   io_threads=args.io_threads)
+            start   = time()
+            snps.write(prefix + 'SNP_COUNTS' + ext, binary=args.npz)
+            metrics.add('output', time() - start)
+            if args.profile:
+                run.merge_profiles(
+                    [run.profile_name(args.profile, str(i+1).zfill(4))
+                     for i in range(len(pieces))],
+                    run.profile_name(args.profile, 'workers'))
+            if args.metrics:
+                write_metrics(aggregate(args.prefix,
+                                        [metrics.as_dict()] + workers,
+                                        time() - metrics.start),
+                              prefix + 'metrics.json')
+            return 0
 
         # Create PBS scripts and submit jobs to the cluster
         subnoclean = ' --noclean' if args.noclean else ''
+        subnoclean += ' --npz' if args.npz else ''
+        subnoclean += ' --hash-choice' if args.hash_choice else ''
+        subnoclean += ' --metrics' if args.metrics else ''
+        subnoclean += ' --io-threads ' + str(args.io_threads)
+        if args.random_seed is not None:
+            subnoclean += ' --random-seed ' + str(args.random_seed)
+        # Build the SNP index once here, so the jobs only memory map it
+        load_snp_index(args.snps)
+
+        # Every job is run under cProfile by cluster.submit, the option is
+        # not passed on, so each job writes PROFILE.PREFIX_SUFFIX only once.
+        cluster.PROFILE = args.profile
         logme.log('Submitting split files to cluster')
-        jobs = []  # Hold job info for later checking
-        for reads_file in reads_files:
-            suffix = reads_file[-4:]
+        start    = time()
+        jobs     = []  # Hold job info for later checking
+        suffixes = []
+        for i, job_arg in enumerate(job_args):
+            suffix = str(i+1).zfill(4)
+            suffixes.append(suffix)
 
             command = ("python2 " + program_name + " --mode single --snps " +
-                       args.snps + " --reads " + reads_file + " --suffix " +
-                       suffix + " --prefix " + args.prefix + subnoclean +
-                       ' --bam')
+                       args.snps + job_arg + " --suffix " + suffix +
+                       " --prefix " + args.prefix + subnoclean)
 
-            if cluster_type == 'normal':
-                jobs.append(cluster.submit(command, name=prefix + suffix,
-                                           threads=args.threads))
-            else:
-                jobs.append(cluster.submit(command, name=prefix + suffix,
-                                           time=args.walltime, cores=1,
-                                           mem=args.memory,
-                                           partition=args.queue))
+            jobs.append(cluster.submit(command, name=prefix + suffix,
+                                       time=args.walltime,
+                                       cores=args.io_threads,
+                                       mem=args.memory, partition=args.queue))
             sleep(2)    # Pause for two seconds to make sure job is submitted
 
         # Now wait and check for all jobs to complete every so long
@@ -374,8 +1165,7 @@ def main(argv=None):
 
         # Next, check if any jobs failed
         failed = []
-        for i in range(1, args.jobs+1):
-            suffix = str(i).zfill(4)
+        for suffix in suffixes:
             if not os.path.isfile(prefix + suffix + '_done'):
                 failed.append(prefix + suffix)
 
@@ -388,83 +1178,75 @@ def main(argv=None):
         # Remove 'done' files in case we want to run again.
         os.system('rm {prefix}*_done'.format(prefix=prefix))
 
-        # Once the jobs are done, concatenate all of the counts into one file.
-        # Initialize dictionaries
-
-        tot_pos_counts = {}
-        tot_neg_counts = {}
-        tot_tot_counts = {}
-        tot_sum_pos = {}
-        tot_sum_neg = {}
-
-        for i in range(1, args.jobs+1):
-            suffix = str(i).zfill(4)
-            in_counts = prefix + 'SNP_COUNTS_' + suffix
-
-            # Parse the line to add it to the total file
-            with run.open_zipped(in_counts, 'r') as in_counts:
-                for line in in_counts:
-                    line = line.rstrip('\n')
-                    line_t = line.split('\t')
-
-                    if 'CHR' in line:
-                        continue
+        # Once the jobs are done, merge all of the counts into one file. Each
+        # job writes its counts sorted, so a streaming merge keeps the same
+        # order without loading the SNPs or sorting again.
+        merge_count_files([prefix + 'SNP_COUNTS_' + i for i in suffixes],
+                          prefix + 'SNP_COUNTS' + ext, binary=args.npz)
 
-                    pos = line_t[0] + '|' + line_t[1]
+        if args.metrics:
+            workers = [read_metrics(prefix + 'metrics_' + i + '.json')
+                       for i in suffixes]
+            write_metrics(aggregate(args.prefix, workers, time() - start),
+                          prefix + 'metrics.json')
 
-                    pos_split = line_t[2].split('|')
-                    neg_split = line_t[3].split('|')
-
-                    if pos in tot_pos_counts or pos in tot_neg_counts or pos in tot_tot_counts:
-                        for j in range(len(pos_split)):
-                            tot_pos_counts[pos][j] += int(pos_split[j])
-                            tot_neg_counts[pos][j] += int(neg_split[j])
-                        tot_sum_pos[pos] += int(line_t[4])
-                        tot_sum_neg[pos] += int(line_t[5])
-                        tot_tot_counts[pos] += int(line_t[6])
-
-                    else:
-                        tot_pos_counts[pos] = [0, 0, 0, 0]
-                        tot_neg_counts[pos] = [0, 0, 0, 0]
-                        tot_tot_counts[pos] = 0
-                        tot_sum_pos[pos] = 0
-                        tot_sum_neg[pos] = 0
-                        for j in range(len(pos_split)):
-                            tot_pos_counts[pos][j] += int(pos_split[j])
-                            tot_neg_counts[pos][j] += int(neg_split[j])
-                        tot_sum_pos[pos] += int(line_t[4])
-                        tot_sum_neg[pos] += int(line_t[5])
-                        tot_tot_counts[pos] += int(line_t[6])
-
-        # Write out the final concatenated file
-        with run.open_zipped(prefix + 'SNP_COUNTS.txt', 'w') as final_counts:
-            final_counts.write('CHR\tPOSITION\tPOS_A|C|G|T\tNEG_A|C|G|T\t' +
-                               'SUM_POS_READS\tSUM_NEG_READS\tSUM_READS\n')
-
-            keys = sorted(tot_pos_counts.keys())
-
-            for key in keys:
-                pos = key.split('|')
-                pos_fix = [str(x) for x in tot_pos_counts[key]]
-                neg_fix = [str(x) for x in tot_neg_counts[key]]
-                pos_out = '|'.join(pos_fix)
-                neg_out = '|'.join(neg_fix)
-                final_counts.write(str(pos[0]) + '\t' + str(pos[1]) + '\t' +
-                                   pos_out + '\t' + neg_out + '\t' +
-                                   str(tot_sum_pos[key]) + '\t' +
-                                   str(tot_sum_neg[key]) + '\t' +
-                                   str(tot_tot_counts[key]) + '\n')
-
-        # Sort the file numerically
-        os.system('sort -k1,2 -n ' + prefix + 'SNP_COUNTS.txt ' + ' -o ' +
-                  prefix + 'SNP_COUNTS.txt')
+        if args.profile:
+            run.merge_profiles([run.profile_name(args.profile, prefix + i)
+                                for i in suffixes],
+                               run.profile_name(args.profile, 'workers'))
 
         # Clean up intermediate files.
         if args.noclean is False:
             cluster.clean()
-            os.system('rm {prefix}*COUNTS_* {prefix}*split_sam_*'.format(
+            os.system('rm -f {prefix}*COUNTS_* {prefix}metrics_*'.format(
                 prefix=prefix))
 
+    ##############
+    # BATCH MODE #
+    ##############
+
+    # Count many files against one loaded SNP list, either one after the
+    # other or in a pool of --threads processes.
+    elif args.mode == 'batch':
+        names = [sample_name(i) for i in reads_files]
+        if len(set(names)) != len(names):
+            logme.log('Reads files must have unique names in batch mode',
+                      'critical')
+            return -1
+
+        snps = SNPCounts.from_bed(args.snps)
+
+        # Each file counted in the pool writes its own profile, named after
+        # the sample, a single process is profiled as a whole.
+        threads  = min(args.threads, len(reads_files))
+        profiles = [run.profile_name(args.profile, i) for i in names] \
+            if args.profile and threads > 1 else [None]*len(names)
+
+        jobs = []
+        for reads_file, name, profile in zip(reads_files, names, profiles):
+            rmode   = 'rb' if reads_file.endswith('bam') or args.bam else 'r'
+            outfile = None if args.matrix else \
+                prefix + name + '_SNP_COUNTS' + ext
+            jobs.append((reads_file, rmode, outfile, args.npz, args.stream,
+                         args.coordinate, args.random_seed, hash_seed,
+                         args.io_threads, profile))
+
+        if threads > 1:
+            pool    = Pool(threads, _init_worker, (snps,))
+            results = pool.map(_count_batch_file, jobs, chunksize=1)
+            pool.close()
+            pool.join()
+        else:
+            _init_worker(snps)
+            results = [_count_batch_file(job) for job in jobs]
+
+        if args.matrix:
+            write_matrix(snps, results, prefix + 'SNP_MATRIX.txt')
+
+        if args.profile and threads > 1:
+            run.merge_profiles(profiles,
+                               run.profile_name(args.profile, 'workers'))
+
     ###############
     # SINGLE MODE #
     ###############
@@ -473,219 +1255,65 @@ def main(argv=None):
     # will be running in single mode)
     elif args.mode == 'single':
 
-        # First read in the information on the SNPs that we're interested in.
-        snps = {}    # Initialize a dictionary of SNP positions
-
-        with run.open_zipped(args.snps) as snp_file:
-            for line in snp_file:
-                line = line.rstrip('\n')
-                line_t = line.split('\t')
-
-                pos = chrom_to_num(line_t[0]) + '|' + str(line_t[2])
-                snps[pos] = line_t[3]
-
-        # This is the dictionary of potential SNPs for each read.
-        potsnp_dict = {}
-
-        # Now parse the SAM file to extract only reads overlapping SNPs.
-        in_sam     = Samfile(args.reads, mode)
-        references = in_sam.references  # Faster to make a copy of references.
-
-        # Trackers to count how many reads are lost at each step
-        indel_skip = 0
-        nosnp_skip = 0
-        count      = 0
-        snp_count  = 0
-        ryo_filter = 0
-
-        for line in in_sam:
-            count += 1
-
-            # Skip lines that overlap indels OR don't match Ns
-            cigarstring = line.cigarstring
-
-            if 'D' in cigarstring or 'I' in cigarstring:
-                indel_skip += 1
-                continue
-
-            # Split the tags to find the MD tag:
-            tags = line.tags
-            for tagname, tagval in tags:
-                if tagname == 'MD' and 'N' in tagval:
-                    # Remember that, for now, we're not allowing reads that
-                    # overlap insertions/deletions.
-
-                    chrom = references[line.rname]
-                    pos   = line.pos
-                    read  = line.seq
-
-                    # We're assuming
-                    # correct mapping such that FIRST MATES on the NEGATIVE
-                    # STRAND are NEGATIVE, while SECOND MATES on the NEGATIVE
-                    # STRAND are POSITIVE.
-
-                    if line.is_reverse:
-                        orientation = '-'
-                    else:
-                        orientation = '+'
-
-                    # Parse the CIGAR string
-                    cigar_types, cigar_vals = split_CIGAR(cigarstring)
+        if args.metrics:
+            metrics = Metrics(prefix + args.suffix if args.suffix
+                              else args.prefix)
+        else:
+            metrics = None
+
+        # First read in the information on the SNPs that we're interested in,
+        # only on the contigs this job can see. A region job loads its own
+        # contig first, and the contigs of distant mates once it meets them.
+        start = time()
+        if args.contigs:
+            snps = SNPCounts.from_bed(args.snps, args.contigs.split(','))
+        elif args.region:
+            snps = SNPCounts.from_bed(args.snps, [parse_region(
+                args.region)[0]], lazy=True)
+        elif args.reads != '-':
+            snps = SNPCounts.from_bed(args.snps, get_contigs(args.reads,
+                                                             mode))
+        else:
+            snps = SNPCounts.from_bed(args.snps)
+        logme.log('Loaded {} SNPs on {} contigs.'.format(
+            len(snps), len(snps.chroms)), 'debug')
+        if metrics:
+            metrics.add('load_snps', time() - start)
+
+        if args.stream and (args.region or args.coordinate):
+            logme.log('--stream cannot be used with --region or ' +
+                      '--coordinate, as mates are not adjacent in a ' +
+                      'coordinate sorted file', 'critical')
+            return -1
 
-                    if cigar_types[0] == 'S':
-                        MD_start = int(cigar_vals[0])
-                    else:
-                        MD_start = 0
-
-                    # Get the genomic positions corresponding to each base-pair
-                    # of the read
-                    read_genomic_positions = CIGAR_to_Genomic_Positions(
-                        cigar_types, cigar_vals, line.pos+1)
-
-                    # Get the tag data
-                    MD_split = re.findall('\d+|\D+', tagval)
-
-                    genome_start = 0
-
-                    # The snp_pos dictionary will store the 1-base position
-                    # => allele
-                    snp_pos = {}
-                    for i in MD_split:
-                        if re.match('\^', i):
-                            pass
-                        elif i.isalpha():
-                            if i == 'N':
-                                snp_pos[read_genomic_positions[genome_start]] = read[MD_start]
-                                MD_start += 1
-                                genome_start += 1
-                            else:
-                                MD_start += 1
-                                genome_start += 1
-                        else:
-                            MD_start += int(i)
-                            genome_start += int(i)
-
-                    for i in snp_pos:
-                        snp_count += 1
-
-                        # RYO: START EDIT - Implemented Filter
-                        posVal = line.reference_name + '|' + str(i)
-                        if posVal not in snps:
-                            nosnp_skip += 1
-                            continue
-                        # RYO: END EDIT - Implmented Filter
-
-                        snp = '{chr}|{i}\t{snp_pos}\t{orientation}'.format(
-                            chr=chrom, i=i, snp_pos=snp_pos[i],
-                            orientation=orientation)
-                        if line.qname in potsnp_dict:
-                            if snp not in potsnp_dict[line.qname]:
-                                # RYO EDIT HERE - added conditional so that
-                                # pairs of reads are not considered twice if
-                                # they both overlap the same snp.
-                                potsnp_dict[line.qname].append(snp)
-                            else:
-                                ryo_filter += 1
-                        else:
-                            potsnp_dict[line.qname] = []
-                            potsnp_dict[line.qname].append(snp)
-
-        in_sam.close()
-
-        # Log all of the skipped reads
-        logme.log('Total reads: {}'.format(count), 'debug')
-        logme.log('Reads skipped for indels: {}'.format(indel_skip), 'debug')
-        logme.log('Total SNPs checked: {}'.format(snp_count), 'debug')
-        logme.log('SNPs not in SNP list: {}'.format(nosnp_skip), 'debug')
-        logme.log('Ryo filter: {}'.format(ryo_filter), 'debug')
-
-        # Initialize the counting dictionaries
-        pos_counts = {}
-        neg_counts = {}
-
-        # Go through the potential SNP dictionary and choose one SNP at random
-        # for those overlapping multiple SNPs
-        if args.random_seed is not None:  # Dictionaries are unordered, so must sort for consistent random seed output.
-            keys = sorted(list(potsnp_dict.keys()))
-        else:  # Because sorting is slow, only do it if random seed is set, slowdown is about 0.1s per 1 million reads..
-            keys = list(potsnp_dict.keys())
-        for key in keys:
-            snp = random.choice(potsnp_dict[key]).split('\t')
-
-            if snp[0] in snps:
-                if snp[0] in pos_counts or snp[0] in neg_counts:
-                    if snp[2] == '+':
-                        if snp[1] == 'A':
-                            pos_counts[snp[0]][0] += 1
-                        if snp[1] == 'C':
-                            pos_counts[snp[0]][1] += 1
-                        if snp[1] == 'G':
-                            pos_counts[snp[0]][2] += 1
-                        if snp[1] == 'T':
-                            pos_counts[snp[0]][3] += 1
-
-                    elif snp[2] == '-':
-                        if snp[1] == 'A':
-                            neg_counts[snp[0]][0] += 1
-                        if snp[1] == 'C':
-                            neg_counts[snp[0]][1] += 1
-                        if snp[1] == 'G':
-                            neg_counts[snp[0]][2] += 1
-                        if snp[1] == 'T':
-                            neg_counts[snp[0]][3] += 1
+        if args.shard and (args.region or args.coordinate):
+            logme.log('--shard cannot be used with --region or ' +
+                      '--coordinate, shards are only cut between read ' +
+                      'names of a name sorted file', 'critical')
+            return -1
 
-                else:
-                    pos_counts[snp[0]] = [0, 0, 0, 0]
-                    neg_counts[snp[0]] = [0, 0, 0, 0]
-                    if snp[2] == '+':
-                        if snp[1] == 'A':
-                            pos_counts[snp[0]][0] += 1
-                        if snp[1] == 'C':
-                            pos_counts[snp[0]][1] += 1
-                        if snp[1] == 'G':
-                            pos_counts[snp[0]][2] += 1
-                        if snp[1] == 'T':
-                            pos_counts[snp[0]][3] += 1
-
-                    elif snp[2] == '-':
-                        if snp[1] == 'A':
-                            neg_counts[snp[0]][0] += 1
-                        if snp[1] == 'C':
-                            neg_counts[snp[0]][1] += 1
-                        if snp[1] == 'G':
-                            neg_counts[snp[0]][2] += 1
-                        if snp[1] == 'T':
-                            neg_counts[snp[0]][3] += 1
+        count_snps(args.reads, snps, mode, region=args.region,
+                   shard=args.shard, stream=args.stream,
+                   coordinate=args.coordinate, random_seed=args.random_seed,
+                   hash_seed=hash_seed, metrics=metrics,
+                   io_threads=args.io_threads)
 
         # Open the output file and write the SNP counts to it
 
         out_counts = prefix + 'SNP_COUNTS_' + args.suffix if args.suffix \
-            else prefix + 'SNP_COUNTS.txt'
-
-        with open(out_counts, 'w') as out_counts:
-            # Write header
-            out_counts.write('CHR\tPOSITION\tPOS_A|C|G|T\tNEG_A|C|G|T\t' +
-                             'SUM_POS_READS\tSUM_NEG_READS\tSUM_READS\n')
-
-            # Sort SNP positions and write them
-            keys = sorted(pos_counts.keys())
-
-            for key in keys:
-                pos = key.split('|')
-                sum_pos = sum(pos_counts[key])
-                sum_neg = sum(neg_counts[key])
-                tot_sum = sum(pos_counts[key]) + sum(neg_counts[key])
-                pos_fix = [str(x) for x in pos_counts[key]]
-                neg_fix = [str(x) for x in neg_counts[key]]
-                positive = '|'.join(pos_fix)
-                negative = '|'.join(neg_fix)
-
-                out_counts.write(pos[0] + '\t' + pos[1] + '\t' + positive +
-                                 '\t' + negative + '\t' + str(sum_pos) + '\t' +
-                                 str(sum_neg) + '\t' + str(tot_sum) + '\n')
+            else prefix + 'SNP_COUNTS' + ext
+
+        start = time()
+        snps.write(out_counts, binary=args.npz)
+
+        if metrics:
+            metrics.add('output', time() - start)
+            write_metrics(metrics.as_dict(),
+                          prefix + 'metrics_' + args.suffix + '.json'
+                          if args.suffix else prefix + 'metrics.json')
 
         if args.suffix:
             os.system('touch ' + prefix + args.suffix + '_done')
 
 if __name__ == '__main__' and '__file__' in globals():
-    sys.exit(main())
+    sys.exit(run.profile_main(main))
@@ -20,11 +20,18 @@ Calculate gene/transcript-level counts from SNP counts.
 ###########
 # MODULES #
 ###########
+import os               # Sample names from file names
 import sys              # Access to simple command-line arguments
 import argparse         # Access to long command-line parsing
+from multiprocessing import Pool  # Count chromosomes in parallel
+
+import numpy as np      # SNP and feature count arrays
 
 # Us
 from ASEr import run    # File handling utilities
+from ASEr.counts import read_count_file  # Text or binary SNP counts
+from ASEr.snpindex import load_snp_index  # Cached SNP BED arrays
+from ASEr.annotation import load_annotation, AnnotationError
 
 ##########################
 # COMMAND-LINE ARGUMENTS #
@@ -55,6 +62,9 @@ Detailed description of inputs/outputs follows:
     the -t/--type option sets the feature type (column 3) from which to pull features
     typically you'd want to count from 'exon', but many annotations may use non-standard
     terms.
+    The lines of the type are saved the first time as arrays, in a [GFF].[TYPE].[ID].annidx
+    directory next to the annotation, which later runs with the same -t and -i memory map
+    instead of parsing the file again, until the annotation changes.
 
 -m/--min
     This sets the minimum # of reads required to include a SNP in the calculation of the
@@ -69,6 +79,22 @@ Detailed description of inputs/outputs follows:
     If the data come from a stranded library prep, then this option will only count reads
     mapped to the corresponding strand.
 
+--matrix
+    Count many samples at once: give -c every SNP counts file, the SNPs of each feature
+    are then found only once. Writes features x samples tables, with one column per
+    file, named by the file without its path, extension and _SNP_COUNTS:
+        [OUTFILE]                  FEATURE, CHROMOSOME, ORIENTATION and START-STOP
+        [OUTFILE].ref.txt          REFERENCE_COUNTS
+        [OUTFILE].alt.txt          ALT_COUNTS
+        [OUTFILE].n_snps.txt       TOTAL_SNPS (0 instead of NA)
+        [OUTFILE].ref_biased.txt   REF_BIASED
+        [OUTFILE].alt_biased.txt   ALT_BIASED
+
+--threads/--processes
+    Annotation lines, phased SNPs and counts never cross chromosomes, so the SNPs of the
+    lines of each chromosome are found and added up on their own, in this many processes
+    at a time. Output is the same for any number of processes.
+
 OUTPUT:
 
 The output of the script is a tab-delimited text file set by -o/--outfile, which contains
@@ -104,59 +130,462 @@ ALT_COUNTS         Alternate base counts
 """
 
 
-def read_snp_count_file(snp_file):
-    """Return a position data structure from a SNP counts file.
+# Column of each base in a SNP counts matrix
+BASES = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
 
-    The SNP counts file come from CountSNPASE
+# The annotation and phased SNPs shared by all worker processes of a pool
+WORKER_DATA = None
 
-    :returns: A dictionary with the format:
-                position => {pos_dict[BASE] => positive strand count
-                             neg_dict[BASE] => negative strand count
 
-    """
-    snp_counts_dict = {}
-    with run.open_zipped(snp_file) as count_file:
-        for line in count_file:
-            if 'SUM_POS_READS' in line:
-                continue
+def read_phased_arrays(snp_file):
+    """Return the phased SNPs of a BED as arrays, by chromosome.
 
-            line   = line.rstrip('\n')
-            line_t = line.split('\t')
+    If a SNP is in the BED twice, the last one is kept.
 
-            pos = line_t[0] + '|' + str(line_t[1])
+    :returns: A dictionary of chromosome => (positions, phases, ref_cols,
+              alt_cols), the sorted 1-based positions, the REF|ALT string,
+              and the count matrix column of the REF and ALT base of every
+              SNP (-1 if the base is not A, C, G or T).
+    """
+    index  = load_snp_index(snp_file)
+    phases = {}
+    for chrom in index.chroms:
+        rows      = index.chrom_rows(chrom)
+        positions = np.asarray(index.positions[rows])
+        last      = np.append(positions[1:] != positions[:-1], True)
+        names     = index.names[rows][last].astype(str)
+
+        # Only the few distinct REF|ALT strings are split
+        refalts, inverse = np.unique(names, return_inverse=True)
+        ref_cols = np.array([BASES.get(i.split('|')[0], -1)
+                             for i in refalts.tolist()], dtype=np.int64)
+        alt_cols = np.array([BASES.get((i.split('|') + [''])[1], -1)
+                             for i in refalts.tolist()], dtype=np.int64)
+        phases[chrom] = (positions[last], names, ref_cols[inverse],
+                         alt_cols[inverse])
+    return phases
+
+
+def read_count_arrays(count_file):
+    """Return the counts of a SNP counts file as arrays, by chromosome.
+
+    :returns: A dictionary of chromosome => (positions, counts), the sorted
+              1-based positions and an int64 (n, 2, 4) count matrix.
+    """
+    data   = read_count_file(count_file)
+    counts = {}
+    for chrom_id, chrom in enumerate(data['chroms'].tolist()):
+        rows  = data['chrom_ids'] == chrom_id
+        order = np.argsort(data['positions'][rows], kind='mergesort')
+        counts[chrom] = (data['positions'][rows][order],
+                         data['counts'][rows][order].astype(np.int64))
+    return counts
+
+
+def feature_hits(annotation, phases, chrom_ids=None):
+    """Find the phased SNPs inside every line of an annotation.
+
+    A SNP inside two lines of a feature is found twice, as every line is
+    counted on its own.
+
+    :annotation: An Annotation, see ASEr.annotation.
+    :phases:     The dictionary returned by read_phased_arrays().
+    :chrom_ids:  Only use the lines of these annotation chromosome ids.
+    :returns:    A dictionary of arrays with one entry per SNP in a line,
+                 sorted by line and then position: 'lines' (the line
+                 number), 'chroms' (the annotation chromosome id),
+                 'positions', 'phases', 'ref_cols' and 'alt_cols'.
+    """
+    pieces = []
+    for chrom_id, chrom in enumerate(annotation.chroms):
+        if chrom not in phases or \
+                (chrom_ids is not None and chrom_id not in chrom_ids):
+            continue
+        positions, names, ref_cols, alt_cols = phases[chrom]
+        lines  = np.flatnonzero(np.asarray(annotation.chrom_ids) == chrom_id)
+        starts = positions.searchsorted(annotation.starts[lines], 'left')
+        ends   = positions.searchsorted(annotation.ends[lines], 'right')
+        sizes  = np.maximum(ends - starts, 0)
+
+        # The SNPs of each line are the range starts:ends of the arrays
+        snps = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes,
+                                                  sizes)
+        snps += np.repeat(starts, sizes)
+        pieces.append((np.repeat(lines, sizes),
+                       np.full(len(snps), chrom_id, dtype=np.int32),
+                       positions[snps], names[snps], ref_cols[snps],
+                       alt_cols[snps]))
+
+    keys = ['lines', 'chroms', 'positions', 'phases', 'ref_cols', 'alt_cols']
+    if not pieces:
+        return dict([(i, np.zeros(0, dtype=np.int64)) for i in keys])
+    hits  = dict([(i, np.concatenate([j[k] for j in pieces]))
+                  for k, i in enumerate(keys)])
+    order = np.argsort(hits['lines'], kind='mergesort')
+    return dict([(i, j[order]) for i, j in hits.items()])
+
+
+def hit_counts(annotation, hits, counts):
+    """Return the counts of one sample at every SNP of feature_hits().
+
+    :counts:  The dictionary returned by read_count_arrays().
+    :returns: A tuple of (found, counts), True for every SNP in the counts
+              file, and the (hits, 2, 4) count matrix, zero if not found.
+    """
+    found  = np.zeros(len(hits['lines']), dtype=bool)
+    totals = np.zeros((len(found), 2, 4), dtype=np.int64)
+    for chrom_id, chrom in enumerate(annotation.chroms):
+        if chrom not in counts:
+            continue
+        positions, chrom_counts = counts[chrom]
+        rows  = np.flatnonzero(hits['chroms'] == chrom_id)
+        index = positions.searchsorted(hits['positions'][rows])
+        index[index == len(positions)] = 0
+        match = positions[index] == hits['positions'][rows] \
+            if len(positions) else np.zeros(len(rows), dtype=bool)
+        found[rows[match]]  = True
+        totals[rows[match]] = chrom_counts[index[match]]
+    return found, totals
+
+
+def feature_totals(annotation, hits, found, counts, stranded=False,
+                   min_reads=10):
+    """Add up the REF and ALT counts of the SNPs of every feature.
+
+    :found:     Which SNPs have counts, see hit_counts().
+    :counts:    The (hits, 2, 4) count matrix of hit_counts().
+    :stranded:  Only count the strand of each line, lines on neither strand
+                only add to 'snps'.
+    :min_reads: Reads needed at a SNP for it to be REF or ALT biased.
+    :returns:   A dictionary of arrays, by feature id: 'snps', 'counted'
+                (False if no SNP of the feature had counts), 'ref', 'alt',
+                'ref_biased', 'alt_biased' and 'ratio'. Also 'used' (True
+                for SNPs in ref and alt), 'hit_ref' and 'hit_alt' of every
+                hit.
+    """
+    lines    = hits['lines']
+    features = np.asarray(annotation.feature_ids)[lines]
+    phased   = found & (hits['ref_cols'] >= 0) & (hits['alt_cols'] >= 0)
+    rows     = np.arange(len(lines))
+    ref_cols = np.maximum(hits['ref_cols'], 0)
+    alt_cols = np.maximum(hits['alt_cols'], 0)
+    pos_ref  = counts[rows, 0, ref_cols]
+    neg_ref  = counts[rows, 1, ref_cols]
+    pos_alt  = counts[rows, 0, alt_cols]
+    neg_alt  = counts[rows, 1, alt_cols]
+
+    if stranded:
+        strands = np.asarray(annotation.strands)[lines]
+        plus    = strands == '+'
+        used    = phased & (plus | (strands == '-'))
+        ref     = np.where(plus, pos_ref, neg_ref)
+        alt     = np.where(plus, pos_alt, neg_alt)
+    else:
+        used = phased
+        ref  = pos_ref + neg_ref
+        alt  = pos_alt + neg_alt
+
+    size       = len(annotation.names)
+    enough     = used & (ref + alt >= min_reads)
+    ref_biased = np.bincount(features[enough & (ref > alt)], minlength=size)
+    alt_biased = np.bincount(features[enough & (ref < alt)], minlength=size)
+
+    return {'snps':       np.bincount(features[phased], minlength=size),
+            'counted':    np.bincount(features[used], minlength=size) > 0,
+            'ref':        _sum_by(features[used], ref[used], size),
+            'alt':        _sum_by(features[used], alt[used], size),
+            'ref_biased': ref_biased, 'alt_biased': alt_biased,
+            'ratio':      _biased_ratio(ref_biased, alt_biased),
+            'used': used, 'hit_ref': ref, 'hit_alt': alt}
+
+
+def _init_worker(annotation, phases):
+    """Share the annotation and phased SNPs with a worker process."""
+    global WORKER_DATA
+    WORKER_DATA = (annotation, phases)
+
+
+def _find_hits(job):
+    """Find the phased SNPs inside the lines of one chromosome.
+
+    :job:     A tuple of (chrom_id, profile), profile is the file to write a
+              cProfile dump to, or None.
+    :returns: The hits of the chromosome, see feature_hits().
+    """
+    chrom_id, profile = job
+    annotation, phases = WORKER_DATA
+    return run.profile_call(profile, feature_hits, annotation, phases,
+                            [chrom_id])
 
-            pos_counts = line_t[2].split('|')
-            neg_counts = line_t[3].split('|')
-            bases = ['A', 'C', 'G', 'T']
 
-            pos_dict = {}
-            neg_dict = {}
+def _count_chrom(job):
+    """Add up the counts of one sample at the SNPs of one chromosome.
 
-            for i in range(len(pos_counts)):
-                pos_dict[bases[i]] = pos_counts[i]
-                neg_dict[bases[i]] = neg_counts[i]
+    :job:     A tuple of (chrom, hits, counts, stranded, min_reads, profile),
+              hits are those of the chromosome, counts is its (positions,
+              counts) in the sample, or None if it has none, profile is the
+              file to write a cProfile dump to, or None.
+    :returns: The totals of the chromosome, see feature_totals().
+    """
+    chrom, hits, counts, stranded, min_reads, profile = job
+    return run.profile_call(profile, _chrom_totals, WORKER_DATA[0], chrom,
+                            hits, counts, stranded, min_reads)
+
+
+def _chrom_totals(annotation, chrom, hits, counts, stranded, min_reads):
+    """Return the feature_totals() of the hits of one chromosome."""
+    found, hit_matrix = hit_counts(annotation, hits,
+                                   {chrom: counts} if counts else {})
+    return feature_totals(annotation, hits, found, hit_matrix, stranded,
+                          min_reads)
+
+
+def count_features(annotation, phases, count_files, stranded=False,
+                   min_reads=10, threads=1, profile=None):
+    """Yield the counts of every SNP counts file in every feature.
+
+    Annotation lines, phased SNPs and counts never cross chromosomes, so
+    the SNPs of the lines of each chromosome are found once, and then
+    looked up and added up in every file, one chromosome at a time. With
+    threads > 1 both steps run in one pool of processes.
+
+    :count_files: A list of SNP counts files.
+    :threads:     The number of processes to run at a time.
+    :profile:     A file name, if given every job run in the pool writes a
+                  cProfile dump to profile.hits_0001... or
+                  profile.SAMPLE_0001... (see run.profile_name()), which
+                  are merged into profile.workers.
+    :returns:     A generator of (hits, totals) of all lines, as from
+                  feature_hits() and feature_totals(), of every file.
+    """
+    chrom_ids = [i for i, j in enumerate(annotation.chroms) if j in phases]
+    if not chrom_ids:
+        hits = feature_hits(annotation, {})
+        found, hit_matrix = hit_counts(annotation, hits, {})
+        totals = feature_totals(annotation, hits, found, hit_matrix,
+                                stranded, min_reads)
+        for _ in count_files:
+            yield hits, totals
+        return
+
+    threads  = min(threads, len(chrom_ids))
+    suffixes = [str(i+1).zfill(4) for i in range(len(chrom_ids))]
+    profiles = []
+    if threads > 1:
+        pool    = Pool(threads, _init_worker, (annotation, phases))
+        mapper  = pool.map
+    else:
+        _init_worker(annotation, phases)
+        mapper  = map
+        profile = None
+
+    try:
+        jobs = [(i, run.profile_name(profile, 'hits_' + j) if profile
+                 else None) for i, j in zip(chrom_ids, suffixes)]
+        profiles += [i[1] for i in jobs]
+        chrom_hits = list(mapper(_find_hits, jobs))
+
+        # Workers do not need the REF|ALT strings
+        job_hits = [dict([(i, j) for i, j in hits.items() if i != 'phases'])
+                    for hits in chrom_hits]
+
+        # Back in line and then position order
+        order = np.argsort(np.concatenate([i['lines'] for i in chrom_hits]),
+                           kind='mergesort')
+        hits  = dict([(i, np.concatenate([j[i] for j in chrom_hits])[order])
+                      for i in chrom_hits[0]])
+
+        for count_file in count_files:
+            counts = read_count_arrays(count_file)
+            name   = sample_name(count_file)
+            jobs   = [(annotation.chroms[i], j,
+                       counts.get(annotation.chroms[i]), stranded, min_reads,
+                       run.profile_name(profile, name + '_' + k)
+                       if profile else None)
+                      for i, j, k in zip(chrom_ids, job_hits, suffixes)]
+            profiles += [i[-1] for i in jobs]
+            results = list(mapper(_count_chrom, jobs))
+            yield hits, _merge_totals(results, order)
+    finally:
+        if threads > 1:
+            pool.close()
+            pool.join()
+        if profile:
+            run.merge_profiles(profiles,
+                               run.profile_name(profile, 'workers'))
+
+
+def _merge_totals(results, order):
+    """Merge the feature_totals() of every chromosome into one.
+
+    :order: Puts the concatenated hits of all chromosomes in line order.
+    """
+    totals = dict([(i, np.concatenate([j[i] for j in results])[order])
+                   for i in ['used', 'hit_ref', 'hit_alt']])
+    for key in ['snps', 'ref', 'alt', 'ref_biased', 'alt_biased']:
+        totals[key] = np.sum([i[key] for i in results], axis=0)
+    totals['counted'] = np.any([i['counted'] for i in results], axis=0)
+    totals['ratio']   = _biased_ratio(totals['ref_biased'],
+                                      totals['alt_biased'])
+    return totals
 
-            snp_counts_dict[pos] = [pos_dict, neg_dict]
-    return snp_counts_dict
 
+def feature_spans(annotation):
+    """Return the chromosome, strand, and start and stop of every feature.
 
-def read_snp_phasing_file(snp_file):
-    """Return a dictionary of phased SNPs by genome position.
+    The chromosome and strand are those of the last line of each feature,
+    start and stop span all of its lines.
 
-    :snp_file: A bed format file with phased SNPs, can be produces with the
-               create_phased_bed script.
-    :returns:  A dictionary of::
-                    position => REF|ALT
+    :returns: A tuple of (chroms, strands, starts, stops) lists by feature id.
+    """
+    size  = len(annotation.names)
+    ids   = np.asarray(annotation.feature_ids)
+    last  = np.full(size, -1, dtype=np.int64)
+    np.maximum.at(last, ids, np.arange(len(ids)))
+    lows  = np.minimum(annotation.starts, annotation.ends)
+    highs = np.maximum(annotation.starts, annotation.ends)
+    starts = np.full(size, np.iinfo(np.int64).max, dtype=np.int64)
+    stops  = np.zeros(size, dtype=np.int64)
+    np.minimum.at(starts, ids, lows)
+    np.maximum.at(stops, ids, highs)
+    chroms = [annotation.chroms[i] for i in
+              np.asarray(annotation.chrom_ids)[last].tolist()]
+    return (chroms, np.asarray(annotation.strands)[last].tolist(),
+            starts.tolist(), stops.tolist())
+
+
+def write_features(annotation, hits, totals, outfile):
+    """Write the counts of every feature of one sample, sorted by name.
+
+    :totals: The dictionary returned by feature_totals().
     """
-    snp_phase_dict = {}
-    with run.open_zipped(snp_file) as snp_file:
-        for line in snp_file:
-            line   = line.rstrip('\n')
-            line_t = line.split('\t')
+    names = annotation.names.tolist()
+    lines = hits['lines']
+    used  = np.flatnonzero(totals['used'])
+
+    # The SNPS column, in line and then position order
+    snps = [[] for i in names]
+    for feature_id, pos, phase, ref, alt in zip(
+            np.asarray(annotation.feature_ids)[lines[used]].tolist(),
+            hits['positions'][used].tolist(), hits['phases'][used].tolist(),
+            totals['hit_ref'][used].tolist(),
+            totals['hit_alt'][used].tolist()):
+        snps[feature_id].append('{},{},{}|{}'.format(pos, phase, ref, alt))
+
+    chroms, strands, starts, stops = feature_spans(annotation)
+    columns = [totals[i].tolist() for i in
+               ['ref', 'alt', 'snps', 'ref_biased', 'alt_biased']]
+    ratios  = [1 if i == 1 else i for i in totals['ratio'].tolist()]
+    counted = totals['counted'].tolist()
+    with open(outfile, 'w') as fout:
+        # Header
+        fout.write('FEATURE\tCHROMOSOME\tORIENTATION\tSTART-STOP\t' +
+                   'REFERENCE_COUNTS\tALT_COUNTS\tTOTAL_SNPS\tREF_BIASED\t' +
+                   'ALT_BIASED\tREF-ALT_RATIO\tSNPS\n')
 
-            pos = str(line_t[0]) + '|' + str(line_t[2])
-            snp_phase_dict[pos] = line_t[3]
-    return snp_phase_dict
+        for i in sorted(range(len(names)), key=names.__getitem__):
+            row = [names[i], chroms[i], strands[i],
+                   '{}-{}'.format(starts[i], stops[i])]
+            # No counts for this feature
+            if not counted[i]:
+                fout.write('\t'.join(row + ['NA'] * 7) + '\n')
+                continue
+            fout.write('\t'.join(
+                [str(j) for j in row + [k[i] for k in columns] +
+                 [ratios[i], ';'.join(snps[i])]]) + '\n')
+
+
+def write_phased_snps(annotation, hits, totals, outfile, stranded=False):
+    """Write the counts of every SNP in every line, for -w.
+
+    Only stranded counts are written, unstranded runs get the header alone.
+    """
+    with open(outfile, 'w') as fout:
+        # Header
+        fout.write('CHROMOSOME\tPOSITION\tFEATURE\tORIENTATION\t' +
+                   'REFERENCE_ALLELE\tALTERNATE_ALLELE\tREF_COUNTS\t' +
+                   'ALT_COUNTS\n')
+        if not stranded:
+            return
+
+        names  = annotation.names.tolist()
+        used   = np.flatnonzero(totals['used'])
+        lines  = hits['lines'][used]
+        for chrom_id, pos, feature_id, strand, phase, ref, alt in zip(
+                np.asarray(annotation.chrom_ids)[lines].tolist(),
+                hits['positions'][used].tolist(),
+                np.asarray(annotation.feature_ids)[lines].tolist(),
+                np.asarray(annotation.strands)[lines].tolist(),
+                hits['phases'][used].tolist(),
+                totals['hit_ref'][used].tolist(),
+                totals['hit_alt'][used].tolist()):
+            refalt = phase.split('|')
+            fout.write('\t'.join([str(i) for i in [
+                annotation.chroms[chrom_id], pos, names[feature_id], strand,
+                refalt[0], refalt[1], ref, alt]]) + '\n')
+
+
+def sample_name(count_file):
+    """Return the name of a SNP counts file, without path or extensions."""
+    name = os.path.basename(count_file)
+    for ext in ['.gz', '.bz2', '.txt', '.npz', '_SNP_COUNTS']:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return name
+
+
+def write_matrices(annotation, phases, count_files, outfile, stranded=False,
+                   min_reads=10, threads=1, profile=None):
+    """Write features x samples tables of many SNP counts files.
+
+    The SNPs of every feature are found once, then looked up in each file,
+    see count_features().
+
+    Writes outfile, with the chromosome, orientation and span of every
+    feature, and outfile.ref.txt, .alt.txt, .n_snps.txt, .ref_biased.txt
+    and .alt_biased.txt with one column per counts file.
+    """
+    names   = annotation.names.tolist()
+    order   = sorted(range(len(names)), key=names.__getitem__)
+    samples = [sample_name(i) for i in count_files]
+    tables  = dict([(i, []) for i in
+                    ['ref', 'alt', 'n_snps', 'ref_biased', 'alt_biased']])
+    for _, totals in count_features(annotation, phases, count_files,
+                                    stranded, min_reads, threads, profile):
+        counted = totals['counted']
+        tables['n_snps'].append(totals['snps'].tolist())
+        for key in ['ref', 'alt', 'ref_biased', 'alt_biased']:
+            tables[key].append([j if k else 'NA' for j, k in
+                                zip(totals[key].tolist(), counted.tolist())])
+
+    chroms, strands, starts, stops = feature_spans(annotation)
+    with open(outfile, 'w') as fout:
+        fout.write('FEATURE\tCHROMOSOME\tORIENTATION\tSTART-STOP\n')
+        for i in order:
+            fout.write('{}\t{}\t{}\t{}-{}\n'.format(
+                names[i], chroms[i], strands[i], starts[i], stops[i]))
+
+    for key, columns in tables.items():
+        with open(outfile + '.' + key + '.txt', 'w') as fout:
+            fout.write('\t'.join(['FEATURE'] + samples) + '\n')
+            for i in order:
+                fout.write('\t'.join([names[i]] + [str(j[i]) for j in
+                                                   columns]) + '\n')
+
+
+def _biased_ratio(ref_biased, alt_biased):
+    """Return the fraction of biased SNPs biased the same way, 1 if all."""
+    ratio = np.maximum(ref_biased, alt_biased) / np.maximum(
+        ref_biased + alt_biased, 1).astype(float)
+    ratio[(ref_biased == 0) | (alt_biased == 0)] = 1
+    return ratio
+
+
+def _sum_by(groups, values, size):
+    """Return the sum of the integer values of every group id."""
+    totals = np.zeros(size, dtype=np.int64)
+    np.add.at(totals, groups, values)
+    return totals
 
 
 def main(argv=None):
@@ -170,16 +599,18 @@ def main(argv=None):
 
     req = parser.add_argument_group('Required arguments:')
     req.add_argument('-c', '--snpcounts', action="store", dest="snpcounts",
-                     help='SNP-level ASE counts from CountSNPASE.py ',
-                     required=True, metavar='')
+                     help='SNP-level ASE counts from CountSNPASE.py ' +
+                     '(text or .npz), --matrix takes many',
+                     nargs='+', required=True, metavar='COUNTS')
     req.add_argument('-p', '--phasedsnps', action="store", dest="phasedsnps",
-                     help='BED file of phased SNPs', required=True, metavar='')
+                     help='BED file of phased SNPs', required=True,
+                     metavar='PHASED')
     req.add_argument('-g', '--gff', action="store", dest="gff",
                      help='GFF/GTF formatted annotation file', required=True,
-                     metavar='')
+                     metavar='GFF')
     req.add_argument('-o', '--outfile', action="store", dest="outfile",
                      help='Gene-level ASE counts output', required=True,
-                     metavar='')
+                     metavar='OUT')
 
     opt = parser.add_argument_group('Optional arguments:')
     opt.add_argument('-w', '--writephasedsnps', action="store_true", dest="write",
@@ -194,326 +625,62 @@ def main(argv=None):
                      default=10)
     opt.add_argument('-s', '--stranded', action="store_true", dest="stranded",
                      help='Data are stranded? [Default: False]')
+    opt.add_argument('--matrix', action='store_true',
+                     help='Count many -c files, write features x samples ' +
+                     'tables [OUTFILE].ref.txt, .alt.txt, .n_snps.txt, ' +
+                     '.ref_biased.txt and .alt_biased.txt')
+    opt.add_argument('--threads', '--processes', type=int, default=1,
+                     dest='threads', metavar='',
+                     help='Max number of processes to count chromosomes in ' +
+                     'at a time')
+    run.add_profile_argument(opt)
 
     opt.add_argument('-h', '--help', action="help",
                      help="Show this help message and exit")
 
     args = parser.parse_args()
 
+    if args.matrix:
+        if args.write:
+            parser.error('-w/--writephasedsnps cannot be used with --matrix')
+        samples = [sample_name(i) for i in args.snpcounts]
+        if len(set(samples)) != len(samples):
+            parser.error('SNP counts files must have unique names')
+    elif len(args.snpcounts) > 1:
+        parser.error('only --matrix takes more than one SNP counts file')
+
     ##########
     # SCRIPT #
     ##########
 
-    # Read in the SNP-level ASE counts
-    snp_counts_dict = read_snp_count_file(args.snpcounts)
+    # Read the lines of the annotation type from its cached index
+    try:
+        annotation = load_annotation(args.gff, args.type, args.id)
+    except AnnotationError as err:
+        sys.stderr.write(str(err) + '\n')
+        sys.stderr.write('GFF info column format is: attribute=value;\n')
+        sys.stderr.write('GTF info column format is: attribute "value";\n')
+        sys.exit(1)
 
     # Read in the SNP phasing information
-    snp_phase_dict = read_snp_phasing_file(args.phasedsnps)
-
-    # Initialize variables for gene-level counts
-    chromosome       = {}
-    position         = {}
-    ori              = {}
-    total_ref        = {}
-    total_alt        = {}
-    total_snps       = {}
-    ref_biased       = {}
-    alt_biased       = {}
-    snp_array        = {}
-    phased_snp_array = []
-
-    features = {}    # We have to store a list of all of the features somewhere
-
-    # Now go through the GFF/GTF and concatenate the approporiate info
-    gff_file = open(args.gff, 'r')
-    with run.open_zipped(args.gff) as gff_file:
-        for line in gff_file:
-            line   = line.rstrip('\n')
-            line_t = line.split('\t')
-
-            if line_t[2] != args.type:
-                continue
+    phases = read_phased_arrays(args.phasedsnps)
 
-            line_t8 = line_t[8].split(';')
-
-            # Check for custom identifier and determine filetype:
-            if args.id + '=' in line_t[8]:    # GFF
-                for i in line_t8:
-                    i.strip()
-                    if args.id + '=' in i:
-                        if args.id in i:
-                            i2 = i.split('=')
-                            name = i2[1]
-
-            elif args.id + ' ' in line_t[8]:  # GTF
-                for i in line_t8:
-                    i.strip()
-                    if args.id + ' ' in line_t[8]:
-                        if args.id in i:
-                            i2 = i.split('"')
-                            name = i2[1]
-
-            else:
-                sys.stderr.write(('ID attribute "{}" doesn\'t exist or GFF/GTF file ' +
-                                  'not properly formatted.\n').format(args.id))
-                sys.stderr.write('GFF info column format is: attribute=value;\n')
-                sys.stderr.write('GTF info column format is: attribute "value";\n')
-                sys.exit(1)
-
-            features[name] = 1
-            chromosome[name] = line_t[0]
-
-            ori[name] = line_t[6]
-            orientation = line_t[6]
-
-            if name not in position:
-                position[name] = []
-                position[name].append(int(line_t[3]))
-                position[name].append(int(line_t[4]))
-            else:
-                position[name].append(int(line_t[3]))
-                position[name].append(int(line_t[4]))
-
-            # Now go through the positions overlapped by the annotation and add in SNPs if appropriate
-            for i in range(int(line_t[3]), int(line_t[4])+1):
-                pos = line_t[0] + '|' + str(i)
-
-                if pos in snp_counts_dict and pos in snp_phase_dict:
-
-                    # Count SNPs
-                    if name in total_snps:
-                        total_snps[name] += 1
-                    else:
-                        total_snps[name] = 0
-                        total_snps[name] += 1
-
-                    # Get REF|ALT counts
-                    # Parse the REF|ALT dict
-                    refalt = snp_phase_dict[pos].split('|')
-
-                    # Get pos/neg counts
-                    ref_pos_counts = snp_counts_dict[pos][0][refalt[0]]
-                    ref_neg_counts = snp_counts_dict[pos][1][refalt[0]]
-                    alt_pos_counts = snp_counts_dict[pos][0][refalt[1]]
-                    alt_neg_counts = snp_counts_dict[pos][1][refalt[1]]
-
-                    # If stranded add only appropriate strand counts
-                    if args.stranded is True:
-                        if orientation == '+':
-                            if name in total_ref:
-                                total_ref[name] += int(ref_pos_counts)
-                            else:
-                                total_ref[name] = 0
-                                total_ref[name] += int(ref_pos_counts)
-
-                            if name in total_alt:
-                                total_alt[name] += int(alt_pos_counts)
-                            else:
-                                total_alt[name] = 0
-                                total_alt[name] += int(alt_pos_counts)
-
-                            if name not in ref_biased:
-                                ref_biased[name] = 0
-                            if name not in alt_biased:
-                                alt_biased[name] = 0
-
-                            # Determine if ref or alt biased
-                            if ref_pos_counts + alt_pos_counts >= args.min:
-                                if ref_pos_counts > alt_pos_counts:
-                                    ref_biased[name] += 1
-
-                                elif ref_pos_counts < alt_pos_counts:
-                                    alt_biased[name] += 1
-
-                            # Add it to the total SNP arrays
-                            if name in snp_array:
-                                snp_array[name].append(
-                                    str(i) + ',' + str(snp_phase_dict[pos]) +
-                                    ',' + str(ref_pos_counts) + '|' +
-                                    str(alt_pos_counts))
-                                phased_snp_array.append(
-                                    str(chromosome[name]) + '\t' + str(i) +
-                                    '\t' + name + '\t' + ori[name] + '\t' +
-                                    str(refalt[0]) + '\t' + str(refalt[1]) +
-                                    '\t' + str(ref_pos_counts) + '\t' +
-                                    str(alt_pos_counts))
-                            else:
-                                snp_array[name] = []
-                                snp_array[name].append(
-                                    str(i) + ',' + str(snp_phase_dict[pos]) +
-                                    ',' + str(ref_pos_counts) + '|' +
-                                    str(alt_pos_counts))
-                                phased_snp_array.append(
-                                    str(chromosome[name]) + '\t' + str(i) +
-                                    '\t' + name + '\t' + ori[name] + '\t' +
-                                    str(refalt[0]) + '\t' + str(refalt[1]) +
-                                    '\t' + str(ref_pos_counts) + '\t' +
-                                    str(alt_pos_counts))
-
-                        elif orientation == '-':
-                            if name in total_ref:
-                                total_ref[name] += int(ref_neg_counts)
-                            else:
-                                total_ref[name] = 0
-                                total_ref[name] += int(ref_neg_counts)
-
-                            if name in total_alt:
-                                total_alt[name] += int(alt_neg_counts)
-                            else:
-                                total_alt[name] = 0
-                                total_alt[name] += int(alt_neg_counts)
-
-                            if name not in ref_biased:
-                                ref_biased[name] = 0
-                            if name not in alt_biased:
-                                alt_biased[name] = 0
-
-                            # Determine if ref or alt biased
-                            if ref_neg_counts + alt_neg_counts >= args.min:
-                                if ref_neg_counts > alt_neg_counts:
-                                    ref_biased[name] += 1
-
-                                elif ref_neg_counts < alt_neg_counts:
-                                    alt_biased[name] += 1
-
-                            # Add it to the total SNP array
-                            if name in snp_array:
-                                snp_array[name].append(
-                                    str(i) + ',' + str(snp_phase_dict[pos]) +
-                                    ',' + str(ref_neg_counts) + '|' +
-                                    str(alt_neg_counts))
-                                phased_snp_array.append(
-                                    str(chromosome[name]) + '\t' + str(i) +
-                                    '\t' + name + '\t' + ori[name] + '\t' +
-                                    str(refalt[0]) + '\t' + str(refalt[1]) +
-                                    '\t' + str(ref_neg_counts) + '\t' +
-                                    str(alt_neg_counts))
-                            else:
-                                snp_array[name] = []
-                                snp_array[name].append(
-                                    str(i) + ',' + str(snp_phase_dict[pos]) +
-                                    ',' + str(ref_neg_counts) + '|' +
-                                    str(alt_neg_counts))
-                                phased_snp_array.append(
-                                    str(chromosome[name]) + '\t' + str(i) +
-                                    '\t' + name + '\t' + ori[name] + '\t' +
-                                    str(refalt[0]) + '\t' + str(refalt[1]) +
-                                    '\t' + str(ref_neg_counts) + '\t' +
-                                    str(alt_neg_counts))
-
-                    else:
-                        if name in total_ref:
-                            total_ref[name] += int(ref_pos_counts)
-                            total_ref[name] += int(ref_neg_counts)
-                        else:
-                            total_ref[name] = 0
-                            total_ref[name] += int(ref_pos_counts)
-                            total_ref[name] += int(ref_neg_counts)
-
-                        if name in total_alt:
-                            total_alt[name] += int(alt_pos_counts)
-                            total_alt[name] += int(alt_neg_counts)
-                        else:
-                            total_alt[name] = 0
-                            total_alt[name] += int(alt_pos_counts)
-                            total_alt[name] += int(alt_neg_counts)
-
-                        # Determine if ref or alt biased
-                        if name not in ref_biased:
-                            ref_biased[name] = 0
-
-                        if name not in alt_biased:
-                            alt_biased[name] = 0
-
-                        tot_ref = int(ref_pos_counts) + int(ref_neg_counts)
-                        tot_alt = int(alt_pos_counts) + int(alt_neg_counts)
-                        if tot_ref + tot_alt >= args.min:
-                            if tot_ref > tot_alt:
-                                if name in ref_biased:
-                                    ref_biased[name] += 1
-                                else:
-                                    ref_biased[name] = 0
-                                    ref_biased[name] += 1
-
-                                if name in alt_biased:
-                                    pass
-                                else:
-                                    alt_biased[name] = 0
-
-                            elif tot_ref < tot_alt:
-                                if name in alt_biased:
-                                    alt_biased[name] += 1
-                                else:
-                                    alt_biased[name] = 0
-                                    alt_biased[name] += 1
-
-                                if name in ref_biased:
-                                    pass
-                                else:
-                                    ref_biased[name] = 0
-
-                        # Add it to the total SNP array
-                        if name in snp_array:
-                            snp_array[name].append(
-                                str(i) + ',' + str(snp_phase_dict[pos]) +
-                                ',' + str(int(tot_ref)) + '|' +
-                                str(int(tot_alt)))
-                        else:
-                            snp_array[name] = []
-                            snp_array[name].append(
-                                str(i) + ',' + str(snp_phase_dict[pos]) + ',' +
-                                str(int(tot_ref)) + '|' + str(int(tot_alt)))
+    # Count every sample
+    if args.matrix:
+        write_matrices(annotation, phases, args.snpcounts, args.outfile,
+                       args.stranded, args.min, args.threads, args.profile)
+        return 0
 
-    # Print the output
-    keys = sorted(list(features.keys()))
-
-    with open(args.outfile, 'w') as outfile:
-        # Header
-        outfile.write('FEATURE\tCHROMOSOME\tORIENTATION\tSTART-STOP\t' +
-                      'REFERENCE_COUNTS\tALT_COUNTS\tTOTAL_SNPS\tREF_BIASED\t' +
-                      'ALT_BIASED\tREF-ALT_RATIO\tSNPS\n')
-
-        for key in keys:
-            # Get the ultimate 5'-3' positions
-            position[key].sort(key=int)
-            posit = str(position[key][0]) + '-' + str(position[key][-1])
-
-            if key in total_ref:
-                pos = key.split('|')
-                if ref_biased[key] >= alt_biased[key]:
-                    if alt_biased[key] == 0:
-                        rat = 1
-                    else:
-                        rat = ref_biased[key]/float(alt_biased[key]+ref_biased[key])
-                else:
-                    if ref_biased[key] == 0:
-                        rat = 1
-                    else:
-                        rat = alt_biased[key]/float(ref_biased[key]+alt_biased[key])
-
-                snp_array_out = ';'.join(snp_array[key])
-
-                outfile.write('\t'.join(
-                    [str(i) for i in [key, chromosome[key], ori[key], posit,
-                                      total_ref[key], total_alt[key],
-                                      total_snps[key], ref_biased[key],
-                                      alt_biased[key], rat, snp_array_out]]) +
-                              '\n')
-            # No counts for this feature
-            else:
-                outfile.write('\t'.join(
-                    [str(i) for i in [key, chromosome[key], ori[key], posit,
-                                      'NA\tNA\tNA\tNA\tNA\tNA\tNA\n']]))
+    # Add up the SNP-level ASE counts of every feature
+    hits, totals = list(count_features(annotation, phases, args.snpcounts,
+                                       args.stranded, args.min, args.threads,
+                                       args.profile))[0]
 
+    # Print the output
+    write_features(annotation, hits, totals, args.outfile)
     if args.write is True:
-        with open(args.outfile + '.snps.txt', 'w') as outfile:
-            # Header
-            outfile.write('CHROMOSOME\tPOSITION\tFEATURE\tORIENTATION\t' +
-                          'REFERENCE_ALLELE\tALTERNATE_ALLELE\tREF_COUNTS\t' +
-                          'ALT_COUNTS\n')
-
-            for i in phased_snp_array:
-                outfile.write(i + '\n')
+        write_phased_snps(annotation, hits, totals,
+                          args.outfile + '.snps.txt', args.stranded)
 
 if __name__ == '__main__' and '__file__' in globals():
-    sys.exit(main())
+    sys.exit(run.profile_main(main))
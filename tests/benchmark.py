@@ -0,0 +1,505 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark the ASEr pipeline on synthetic data, without any downloads.
+
+============================================================================
+
+        AUTHOR: Michael D Dacre, mike.dacre@gmail.com
+  ORGANIZATION: Stanford University
+       LICENSE: MIT License, property of Stanford, use as you wish
+
+   DESCRIPTION: The logic of this is:
+                    - Generate a random genome with masked SNP positions, and
+                      from it a name sorted and a coordinate sorted BAM with
+                      MD tags (N at every masked SNP), a SNP BED, a phased
+                      SNP BED, a GTF, and a plink recodeAD raw file with a
+                      matching named SNP BED
+                    - Run every stage in its own process and record its wall
+                      time, throughput and peak memory (RSS)
+                    - Write the results to a JSON file, and compare them to
+                      an earlier (baseline) results file if given
+                Data is generated once per scale and seed and then reused.
+
+         USAGE: python tests/benchmark.py [--scale small] [--record FILE]
+                                          [--compare FILE]
+
+                Stages: countsnpase_single, countsnpase_multi,
+                        countsnpase_region, getgenease, recodead and
+                        individual_beds (needs pybedtools)
+
+============================================================================
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import subprocess
+from time import time
+from bisect import bisect_left
+from multiprocessing import Process
+
+#################
+#  Data Scales  #
+#################
+
+# Number of read pairs (fragments) at each scale, the genome grows with it
+SCALES = {'tiny':   5000,
+          'small':  50000,
+          'medium': 500000,
+          'large':  2000000}
+
+READ_LENGTH  = 75
+CHROMS       = ['2L', '2R', '3L', '3R']
+BASES        = 'ACGT'
+INDIVIDUALS  = 50
+
+# Data generated by an older layout of this script is generated again
+DATA_VERSION = 2
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+###############################################################################
+#                               Data Generation                               #
+###############################################################################
+
+
+def make_genome(fragments):
+    """Return a dictionary of chromosome => (sequence, sorted SNP offsets).
+
+    About one base in 60 is a masked SNP, there are about 20 fragments per
+    kb of genome.
+    """
+    import numpy as np
+    length = max(20000, fragments*50//len(CHROMS))
+    bases  = np.frombuffer(BASES.encode(), dtype='S1')
+    genome = {}
+    for chrom in CHROMS:
+        sequence = bases[np.random.randint(0, 4, length)].tobytes().decode()
+        masked   = []
+        pos      = random.randint(10, 60)
+        while pos < length - 10:
+            masked.append(pos)
+            pos += random.randint(10, 110)
+        genome[chrom] = (sequence, masked)
+    return genome
+
+
+def write_snp_beds(genome, outdir):
+    """Write the SNP BED, the phased BED, and the named BED for plink.
+
+    :returns: A list of SNP names.
+    """
+    names = []
+    with open(os.path.join(outdir, 'snps.bed'), 'w') as snps, \
+            open(os.path.join(outdir, 'phased.bed'), 'w') as phased, \
+            open(os.path.join(outdir, 'named.bed'), 'w') as named:
+        for chrom in CHROMS:
+            sequence, masked = genome[chrom]
+            for pos in masked:
+                ref  = sequence[pos]
+                alt  = random.choice([i for i in BASES if i != ref])
+                name = 'rs{}'.format(len(names) + 1)
+                names.append(name)
+                # Older versions of CountSNPASE read the fourth column
+                snps.write('{}\t{}\t{}\t{}|{}\n'.format(chrom, pos, pos+1,
+                                                       ref, alt))
+                phased.write('{}\t{}\t{}\t{}|{}\n'.format(chrom, pos, pos+1,
+                                                         ref, alt))
+                named.write('{}\t{}\t{}\t{}\t0\t+\n'.format(
+                    chrom, pos, pos+1, name))
+    return names
+
+
+def write_gtf(genome, outfile):
+    """Write a GTF of genes of 1-4 exons on both strands."""
+    gene = 0
+    with open(outfile, 'w') as fout:
+        for chrom in CHROMS:
+            length = len(genome[chrom][0])
+            start  = 100
+            while start < length - 3000:
+                gene  += 1
+                strand = random.choice('+-')
+                for _ in range(random.randint(1, 4)):
+                    end = start + random.randint(50, 400)
+                    fout.write(('{}\tbenchmark\texon\t{}\t{}\t.\t{}\t.\t' +
+                                'gene_id "G{}"; transcript_id "T{}";\n')
+                               .format(chrom, start, end, strand, gene,
+                                       gene))
+                    start = end + random.randint(20, 300)
+                start += random.randint(0, 500)
+
+
+def write_recodead(names, outfile):
+    """Write a plink recodeAD raw file of INDIVIDUALS random genotypes."""
+    with open(outfile, 'w') as fout:
+        header = ['FID', 'IID', 'PAT', 'MAT', 'SEX', 'PHENOTYPE']
+        for name in names:
+            header += [name + '_A', name + '_HET']
+        fout.write(' '.join(header) + '\n')
+        for i in range(INDIVIDUALS):
+            line = ['IND{}'.format(i + 1), 'IND{}'.format(i + 1), '0', '0',
+                    '1', '-9']
+            for _ in names:
+                het   = random.random() < 0.3
+                line += ['1' if het else random.choice('02'),
+                         '1' if het else '0']
+            fout.write(' '.join(line) + '\n')
+
+
+def align(genome, chrom, start):
+    """Return (cigartuples, sequence, MD tag) of one read, or None.
+
+    Reads are mostly plain matches, with some spliced, soft clipped and indel
+    reads, every masked base is an N in the MD tag.
+    """
+    sequence, masked = genome[chrom]
+    masked = set(masked[bisect_left(masked, start):
+                        bisect_left(masked, start + 2000)])
+    clip   = random.randint(1, 5) if random.random() < 0.1 else 0
+    rest   = READ_LENGTH - clip
+    kind   = random.random()
+    cigar  = [(4, clip)] if clip else []
+    if kind < 0.15:
+        split  = random.randint(10, rest - 10)
+        cigar += [(0, split), (3, random.randint(50, 800)), (0, rest - split)]
+    elif kind < 0.18:
+        split  = random.randint(10, rest - 10)
+        cigar += [(0, split), (2, 2), (0, rest - split)]
+    elif kind < 0.21:
+        split  = random.randint(10, rest - 12)
+        cigar += [(0, split), (1, 2), (0, rest - split - 2)]
+    else:
+        cigar.append((0, rest))
+
+    seq = [random.choice(BASES) for _ in range(clip)]
+    md  = []
+    run = 0
+    pos = start
+    for op, length in cigar:
+        if op == 0:
+            if pos + length > len(sequence):
+                return None
+            for i in range(pos, pos + length):
+                if i in masked:
+                    md += [str(run), 'N']
+                    run = 0
+                    seq.append(random.choice(BASES))
+                else:
+                    run += 1
+                    seq.append(sequence[i])
+            pos += length
+        elif op == 1:
+            seq += [random.choice(BASES) for _ in range(length)]
+        elif op == 2:
+            md += [str(run), '^' + sequence[pos:pos + length]]
+            run = 0
+            pos += length
+        elif op == 3:
+            pos += length
+    md.append(str(run))
+    return cigar, ''.join(seq), ''.join(md)
+
+
+def write_bams(genome, fragments, outdir):
+    """Write ase.bam (name sorted) and ase.coord.bam (sorted and indexed).
+
+    :returns: The number of reads written.
+    """
+    import pysam
+    header = {'HD': {'VN': '1.0', 'SO': 'queryname'},
+              'SQ': [{'SN': i, 'LN': len(genome[i][0])} for i in CHROMS]}
+    quals  = pysam.qualitystring_to_array('I'*READ_LENGTH)
+    name_bam = os.path.join(outdir, 'ase.bam')
+    count    = 0
+    with pysam.AlignmentFile(name_bam, 'wb', header=header) as fout:
+        for i in range(fragments):
+            tid    = random.randrange(len(CHROMS))
+            chrom  = CHROMS[tid]
+            start  = random.randint(0, len(genome[chrom][0]) - 1200)
+            paired = random.random() < 0.8
+            mates  = [start]
+            if paired:
+                mates.append(start + random.randint(0, 300))
+            reads  = []
+            for mate, mate_start in enumerate(mates):
+                aligned = align(genome, chrom, mate_start)
+                if aligned is None:
+                    continue
+                read = pysam.AlignedSegment()
+                read.query_name      = 'BENCH:{}:{}'.format(tid, i)
+                read.reference_id    = tid
+                read.reference_start = mate_start
+                read.cigartuples     = aligned[0]
+                read.query_sequence  = aligned[1]
+                read.query_qualities = quals[:len(aligned[1])]
+                read.flag            = 16 if random.random() < 0.5 else 0
+                if paired:
+                    read.flag |= 1 | 2 | (64 if mate == 0 else 128)
+                read.mapping_quality = 255
+                read.set_tag('NH', 1)
+                read.set_tag('MD', aligned[2])
+                reads.append(read)
+            if paired and len(reads) == 2:
+                for read, mate in ((reads[0], reads[1]), (reads[1], reads[0])):
+                    read.next_reference_id    = mate.reference_id
+                    read.next_reference_start = mate.reference_start
+                    if mate.is_reverse:
+                        read.flag |= 32
+            elif paired and reads:
+                reads[0].flag |= 8
+            for read in reads:
+                fout.write(read)
+                count += 1
+
+    # Fragments are written in the order they were made, which is not the
+    # samtools read name order ('BENCH:0:10' < 'BENCH:0:2'), so sort by name.
+    pysam.sort('-n', '-o', name_bam + '.tmp', name_bam)
+    os.rename(name_bam + '.tmp', name_bam)
+    coord_bam = os.path.join(outdir, 'ase.coord.bam')
+    pysam.sort('-o', coord_bam, name_bam)
+    pysam.index(coord_bam)
+    return count
+
+
+def generate(outdir, fragments, seed=0):
+    """Generate all benchmark inputs in outdir, unless they already exist.
+
+    numpy and pysam are only imported here, run this in its own process to
+    keep them out of the memory of the benchmark process.
+
+    :returns: A dictionary of data sizes.
+    """
+    import numpy as np
+    info_file = os.path.join(outdir, 'data.json')
+    if os.path.isfile(info_file):
+        with open(info_file) as fin:
+            info = json.load(fin)
+        if info.get('version') == DATA_VERSION:
+            return info
+
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    random.seed(seed)
+    np.random.seed(seed)
+    sys.stderr.write('Generating {} fragments in {}\n'.format(fragments,
+                                                              outdir))
+    genome = make_genome(fragments)
+    names  = write_snp_beds(genome, outdir)
+    write_gtf(genome, os.path.join(outdir, 'ref.gtf'))
+    write_recodead(names, os.path.join(outdir, 'genotypes.raw'))
+    reads  = write_bams(genome, fragments, outdir)
+
+    info = {'fragments': fragments, 'reads': reads, 'snps': len(names),
+            'individuals': INDIVIDUALS, 'seed': seed,
+            'version': DATA_VERSION}
+    with open(info_file, 'w') as fout:
+        json.dump(info, fout, indent=2, sort_keys=True)
+    return info
+
+
+###############################################################################
+#                                Benchmarking                                 #
+###############################################################################
+
+
+def run_stage(command, logfile):
+    """Run command in its own process.
+
+    os.wait4() returns the resource usage of just that process, so the
+    memory of every stage is measured separately. A forked process starts
+    with the memory of its parent, so the peak is never below that of this
+    (small) benchmark process, about 10 MB.
+
+    :returns: (seconds, peak RSS in MB, exit code), the exit code is
+              negative if a signal killed the process, as in subprocess. A
+              stage the code being measured does not support yet fails with
+              a non-zero code instead of stopping the benchmark.
+    """
+    with open(logfile, 'w') as log:
+        start   = time()
+        process = subprocess.Popen(command, stdout=log, stderr=log,
+                                   cwd=os.path.dirname(logfile))
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time() - start
+    # wait4() gives the raw status word, not the exit code
+    if os.WIFEXITED(status):
+        code = os.WEXITSTATUS(status)
+    else:
+        code = -os.WTERMSIG(status)
+    process.returncode = code
+    return seconds, usage.ru_maxrss/1024.0, code
+
+
+def stages(data, outdir, jobs):
+    """Return a list of (name, command, items, unit) of all stages."""
+    python = sys.executable
+    bindir = os.path.join(ROOT_DIR, 'bin')
+    count  = [python, os.path.join(bindir, 'CountSNPASE.py'), '-q',
+              '--snps', os.path.join(data, 'snps.bed')]
+    name_bam  = os.path.join(data, 'ase.bam')
+    coord_bam = os.path.join(data, 'ase.coord.bam')
+    with open(os.path.join(data, 'data.json')) as fin:
+        info = json.load(fin)
+    reads = info['reads']
+    geno  = info['snps']*info['individuals']
+
+    result = [
+        ('countsnpase_single',
+         count + ['--mode', 'single', '--random-seed', '0', '--reads',
+                  name_bam, '--prefix', os.path.join(outdir, 'single')],
+         reads, 'reads'),
+        ('countsnpase_multi',
+         count + ['--mode', 'multi', '--jobs', str(jobs), '--threads',
+                  str(jobs), '--reads', name_bam, '--prefix',
+                  os.path.join(outdir, 'multi')],
+         reads, 'reads'),
+        ('countsnpase_region',
+         count + ['--mode', 'region', '--jobs', str(jobs), '--threads',
+                  str(jobs), '--reads', coord_bam, '--prefix',
+                  os.path.join(outdir, 'region')],
+         reads, 'reads'),
+        ('getgenease',
+         [python, os.path.join(bindir, 'GetGeneASE.py'),
+          '--snpcounts', os.path.join(outdir, 'single_SNP_COUNTS.txt'),
+          '--phasedsnps', os.path.join(data, 'phased.bed'),
+          '--gff', os.path.join(data, 'ref.gtf'),
+          '-o', os.path.join(outdir, 'gene_ase.tsv'), '--writephasedsnps'],
+         info['snps'], 'snps'),
+        ('recodead',
+         [python, '-c', 'import sys; sys.path.insert(0, sys.argv[1]); ' +
+          'from ASEr import snps; ' +
+          'names = snps.snps_from_bed(sys.argv[3]); ' +
+          'print(sum([len(i) for i in ' +
+          'snps.get_het_snps_from_recodeAD(sys.argv[2], names)]))',
+          ROOT_DIR, os.path.join(data, 'genotypes.raw'),
+          os.path.join(data, 'named.bed')],
+         geno, 'genotypes'),
+    ]
+    try:
+        import pybedtools  # noqa
+    except ImportError:
+        sys.stderr.write('pybedtools is not installed, skipping ' +
+                         'individual_beds\n')
+    else:
+        result.append(
+            ('individual_beds',
+             [python, os.path.join(bindir, 'create_individual_snp_files'),
+              '-q', '-o', os.path.join(outdir, 'individuals'),
+              os.path.join(data, 'genotypes.raw'),
+              os.path.join(data, 'named.bed')],
+             geno, 'genotypes'))
+    return result
+
+
+def benchmark(data, outdir, jobs, only=None):
+    """Run all stages, return a dictionary of name => results."""
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    env_path = os.environ.get('PYTHONPATH')
+    os.environ['PYTHONPATH'] = ROOT_DIR + (os.pathsep + env_path
+                                           if env_path else '')
+    results = {}
+    for name, command, items, unit in stages(data, outdir, jobs):
+        if only and name not in only:
+            continue
+        logfile = os.path.join(outdir, name + '.log')
+        seconds, rss, code = run_stage(command, logfile)
+        if code:
+            results[name] = {'failed': True, 'status': code,
+                             'log': logfile}
+            sys.stderr.write('{:<20} failed, see {}\n'.format(name, logfile))
+            continue
+        results[name] = {'seconds': seconds, 'max_rss_mb': rss,
+                         'items': items, 'unit': unit,
+                         'per_second': items/seconds if seconds else 0.0}
+        sys.stderr.write('{:<20} {:>9.2f} s {:>12.0f} {}/s {:>9.1f} MB\n'
+                         .format(name, seconds, results[name]['per_second'],
+                                 unit, rss))
+    return results
+
+
+def compare(results, baseline):
+    """Print the speed and memory of results relative to a baseline.
+
+    Stages that failed in either run are listed as failed.
+    """
+    sys.stdout.write('{:<20} {:>10} {:>10}\n'.format('stage', 'speedup',
+                                                     'memory'))
+    for name in sorted(results):
+        if name not in baseline['stages']:
+            continue
+        old = baseline['stages'][name]
+        new = results[name]
+        if old.get('failed') or new.get('failed'):
+            sys.stdout.write('{:<20} {:>10} {:>10}\n'.format(
+                name, 'failed', 'baseline' if old.get('failed') else 'new'))
+            continue
+        sys.stdout.write('{:<20} {:>9.2f}x {:>9.2f}x\n'.format(
+            name, old['seconds']/new['seconds'],
+            new['max_rss_mb']/old['max_rss_mb']))
+
+
+###############################################################################
+#                                Main Script                                  #
+###############################################################################
+
+
+def main(argv=None):
+    """Generate data, run all stages, record and compare the results."""
+    if not argv:
+        argv = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-s', '--scale', choices=sorted(SCALES),
+                        default='small', help='Size of the generated data')
+    parser.add_argument('-n', '--fragments', type=int,
+                        help='Number of fragments, overrides --scale')
+    parser.add_argument('-d', '--datadir',
+                        default=os.path.join(ROOT_DIR, 'tests', 'testdir',
+                                             'benchmark'),
+                        help='Where to keep generated data and outputs')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='Jobs and threads of multi and region mode')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the generated data')
+    parser.add_argument('--stages', nargs='+', metavar='stage',
+                        help='Only run these stages')
+    parser.add_argument('-r', '--record', metavar='FILE',
+                        help='Write the results to this file')
+    parser.add_argument('-c', '--compare', metavar='FILE',
+                        help='Compare the results to this baseline file')
+
+    args = parser.parse_args(argv)
+
+    fragments = args.fragments if args.fragments else SCALES[args.scale]
+    data      = os.path.join(args.datadir, 'data_{}_{}'.format(fragments,
+                                                                args.seed))
+    # Generate the data in a child process, as the memory it takes would
+    # otherwise be inherited by, and counted for, every stage.
+    generator = Process(target=generate, args=(data, fragments, args.seed))
+    generator.start()
+    generator.join()
+    if generator.exitcode:
+        return generator.exitcode
+    with open(os.path.join(data, 'data.json')) as fin:
+        info = json.load(fin)
+    results   = benchmark(data, os.path.join(args.datadir, 'run'),
+                          args.jobs, args.stages)
+
+    if args.record:
+        with open(args.record, 'w') as fout:
+            json.dump({'data': info, 'jobs': args.jobs, 'stages': results},
+                      fout, indent=2, sort_keys=True)
+            fout.write('\n')
+
+    if args.compare:
+        with open(args.compare) as fin:
+            compare(results, json.load(fin))
+
+if __name__ == '__main__' and '__file__' in globals():
+    sys.exit(main())
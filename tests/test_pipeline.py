@@ -25,8 +25,12 @@ Test the ASEr pipeline for sanity.
 """
 import os
 import sys
+import random
+import shutil
 import hashlib
 
+import pytest
+
 # Python 2/3 compatibility
 try:
     from urllib2 import urlopen
@@ -108,6 +112,22 @@ def get_test_dir():
         os.makedirs(TEST_DIR)
 
 
+@pytest.fixture
+def tmp_dir(request):
+    """Yield an empty directory in the test dir, named for the test.
+
+    The directory, with any SNP or annotation cache built in it, is removed
+    when the test ends, whether it passed or not.
+    """
+    get_test_dir()
+    path = os.path.join(TEST_DIR, request.node.name + '_tmp')
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    yield path
+    shutil.rmtree(path, ignore_errors=True)
+
+
 def get_file(infile):
     """Return path to a file, download if necessary."""
     path = os.path.join(TEST_DIR, infile)
@@ -128,6 +148,154 @@ def download_file(infile):
     return path
 
 
+####################
+#  Generated Data  #
+####################
+
+
+def make_distant_mates(outdir, fragments=600, secondary=False, seed=0):
+    """Write a SNP BED and BAMs of pairs with mates on other chromosomes.
+
+    Writes snps.bed, name.bam, name.sam and name.sam.gz (bgzip, all name
+    sorted) and coord.bam (coordinate sorted and indexed) to outdir, no
+    download needed. Most pairs have
+    their mates on two chromosomes, every read overlaps one or more SNPs.
+    With secondary, the first mate of every third pair also has a secondary
+    alignment at a random position of another chromosome. Reads are
+    drawn from a random.Random(seed).
+    """
+    import pysam
+    rand   = random.Random(seed)
+    chroms = ['2L', '2R', '3L']
+    length = 20000
+    masked = set(range(20, length - 100, 37))
+    with open(os.path.join(outdir, 'snps.bed'), 'w') as fout:
+        for chrom in chroms:
+            for pos in sorted(masked):
+                fout.write('{}\t{}\t{}\tA|G\n'.format(chrom, pos, pos+1))
+
+    header   = {'HD': {'VN': '1.0', 'SO': 'unsorted'},
+                'SQ': [{'SN': i, 'LN': length} for i in chroms]}
+    quals    = pysam.qualitystring_to_array('I'*50)
+
+    def make_read(name, read_tid, read_start, flag):
+        """Return a 50 bp read with an N in its MD tag at every SNP."""
+        sequence = ''
+        md       = ''
+        run      = 0
+        for pos in range(read_start, read_start + 50):
+            if pos in masked:
+                sequence += rand.choice('AG')
+                md       += '{}N'.format(run)
+                run       = 0
+            else:
+                sequence += 'C'
+                run      += 1
+        read = pysam.AlignedSegment()
+        read.query_name      = name
+        read.reference_id    = read_tid
+        read.reference_start = read_start
+        read.cigartuples     = [(0, 50)]
+        read.query_sequence  = sequence
+        read.query_qualities = quals
+        read.flag            = flag
+        if rand.random() < 0.5:
+            read.flag |= 16
+        read.mapping_quality = 255
+        read.set_tag('MD', md + str(run))
+        return read
+
+    unsorted = os.path.join(outdir, 'unsorted.bam')
+    with pysam.AlignmentFile(unsorted, 'wb', header=header) as fout:
+        for i in range(fragments):
+            tid   = rand.randrange(len(chroms))
+            start = rand.randint(0, length - 200)
+            if rand.random() < 0.7:
+                mate = (rand.choice([j for j in range(len(chroms))
+                                     if j != tid]),
+                        rand.randint(0, length - 200))
+            else:
+                mate = (tid, start + rand.randint(0, 100))
+            reads = [make_read('F{}'.format(i), read_tid, read_start,
+                               1 | (64 if first else 128))
+                     for first, (read_tid, read_start) in zip(
+                         [True, False], [(tid, start), mate])]
+            for read, other in ((reads[0], reads[1]), (reads[1], reads[0])):
+                read.next_reference_id    = other.reference_id
+                read.next_reference_start = other.reference_start
+                if other.is_reverse:
+                    read.flag |= 32
+                fout.write(read)
+            if secondary and not i % 3:
+                extra = make_read(
+                    'F{}'.format(i),
+                    rand.choice([j for j in range(len(chroms)) if j != tid]),
+                    rand.randint(0, length - 200), 1 | 64 | 256)
+                extra.next_reference_id    = reads[1].reference_id
+                extra.next_reference_start = reads[1].reference_start
+                if reads[1].is_reverse:
+                    extra.flag |= 32
+                fout.write(extra)
+
+    pysam.sort('-n', '-o', os.path.join(outdir, 'name.bam'), unsorted)
+    pysam.view('-h', '-o', os.path.join(outdir, 'name.sam'),
+               os.path.join(outdir, 'name.bam'), catch_stdout=False)
+    pysam.tabix_compress(os.path.join(outdir, 'name.sam'),
+                         os.path.join(outdir, 'name.sam.gz'), force=True)
+    pysam.sort('-o', os.path.join(outdir, 'coord.bam'), unsorted)
+    pysam.index(os.path.join(outdir, 'coord.bam'))
+    os.remove(unsorted)
+
+
+def make_gene_data(outdir, samples=3):
+    """Write a phased SNP BED, a GTF and SNP counts files of a few samples.
+
+    Writes phased.bed, ref.gtf and sample1_SNP_COUNTS.txt... to outdir, the
+    last sample as a binary sampleN_SNP_COUNTS.npz, no download needed.
+    Genes have one to three exons on either strand, some exons overlap
+    those of other genes, and some have no strand.
+
+    :returns: A list of the SNP counts files.
+    """
+    from ASEr.counts import SNPCounts
+    rand   = random.Random(0)
+    chroms = ['2L', '2R', '3L', 'X']
+    length = 20000
+    snps   = dict([(chrom, range(20, length - 100, 37)) for chrom in chroms])
+    with open(os.path.join(outdir, 'phased.bed'), 'w') as fout:
+        for chrom in chroms:
+            for pos in snps[chrom]:
+                ref, alt = rand.sample('ACGT', 2)
+                fout.write('{}\t{}\t{}\t{}|{}\n'.format(chrom, pos - 1, pos,
+                                                        ref, alt))
+
+    with open(os.path.join(outdir, 'ref.gtf'), 'w') as fout:
+        for gene in range(120):
+            chrom  = rand.choice(chroms)
+            strand = rand.choice('++--.')
+            start  = rand.randint(1, length - 2000)
+            for _ in range(rand.randint(1, 3)):
+                end = start + rand.randint(50, 400)
+                fout.write('\t'.join([
+                    chrom, 'test', 'exon', str(start), str(end), '.', strand,
+                    '.', 'gene_id "G{0}"; transcript_id "T{0}";'.format(
+                        gene)]) + '\n')
+                start = end + rand.randint(-100, 300)
+
+    count_files = []
+    for sample in range(samples):
+        counts = SNPCounts(snps)
+        for _ in range(4000):
+            counts.add(rand.randrange(len(counts)), rand.choice('ACGT'),
+                       rand.choice('+-'))
+        binary = sample == samples - 1
+        count_files.append(os.path.join(
+            outdir, 'sample{}_SNP_COUNTS.{}'.format(
+                sample + 1, 'npz' if binary else 'txt')))
+        counts.write(count_files[-1], binary=binary)
+    return count_files
+
+
 ###############################################################################
 #                               Test Functions                                #
 ###############################################################################
@@ -210,7 +378,515 @@ def test_getgenease():
     snp_hash = hash_file(outfile)
     assert snp_hash == FILES['gene_ase.tsv']['hash']
 
+
+#################
+#  Count Modes  #
+#################
+
+
+def run_countsnpase(options, pipe=None):
+    """Run CountSNPASE.py with options, raise an Exception if it fails.
+
+    :pipe: A file to pipe into the STDIN of CountSNPASE.py.
+    """
+    command = 'python {}/bin/CountSNPASE.py {}'.format(ROOT_DIR, options)
+    if pipe:
+        command = 'cat {} | {}'.format(pipe, command)
+    retcode, stdout, stderr = run.cmd(command)
+    if not retcode == 0:
+        sys.stderr.write('CODE: {}\nSTDOUT:\n{}\nSTDERR:\n{}\n'.format(
+            retcode, stdout, stderr))
+        raise Exception('CountSNPASE.py {} failed'.format(options))
+
+
+def test_region_distant_mates(tmp_dir):
+    """Region mode must count pairs split across chromosomes only once."""
+    # Secondary alignments must not be counted as extra fragments
+    for secondary in [False, True]:
+        make_distant_mates(tmp_dir, secondary=secondary)
+
+        # The hash choice does not depend on the order fragments are
+        # counted in
+        outfiles = []
+        for name, mode, bam in [('single', 'single', 'name.bam'),
+                                ('coordinate', 'single --coordinate',
+                                 'coord.bam'),
+                                ('region', 'region', 'coord.bam')]:
+            run_countsnpase(
+                '--mode {mode} --hash-choice --random-seed 3 --threads 2 '
+                '--reads {bam} --snps {snps} --prefix {prefix}'.format(
+                    mode=mode, bam=os.path.join(tmp_dir, bam),
+                    snps=os.path.join(tmp_dir, 'snps.bed'),
+                    prefix=os.path.join(tmp_dir, name)))
+            outfiles.append(os.path.join(tmp_dir, name + '_SNP_COUNTS.txt'))
+
+        # Name sorted single mode counts the SNPs of secondary alignments as
+        # part of their fragment, the coordinate sorted engines skip them
+        if not secondary:
+            assert hash_file(outfiles[0]) == hash_file(outfiles[1])
+        assert hash_file(outfiles[1]) == hash_file(outfiles[2])
+
+        # Every pair is one fragment
+        for outfile in outfiles:
+            with open(outfile) as fin:
+                fin.readline()
+                assert sum([int(i.rstrip().split('\t')[-1])
+                            for i in fin]) == 600
+
+
+def test_stream(tmp_dir):
+    """Streaming single mode must give the same counts as single mode."""
+    make_distant_mates(tmp_dir, secondary=True)
+
+    outfiles = []
+    for name, options in [('single', ''), ('stream', ' --stream')]:
+        run_countsnpase('--mode single --hash-choice{} --reads {} --snps {} '
+                        '--prefix {}'.format(
+                            options, os.path.join(tmp_dir, 'name.bam'),
+                            os.path.join(tmp_dir, 'snps.bed'),
+                            os.path.join(tmp_dir, name)))
+        outfiles.append(os.path.join(tmp_dir, name + '_SNP_COUNTS.txt'))
+    assert hash_file(outfiles[0]) == hash_file(outfiles[1])
+
+
+def test_stdin(tmp_dir):
+    """Reads piped in on STDIN must give the same counts as the file."""
+    make_distant_mates(tmp_dir)
+    snps = os.path.join(tmp_dir, 'snps.bed')
+
+    run_countsnpase('--mode single --hash-choice --reads {} --snps {} '
+                    '--prefix {}'.format(os.path.join(tmp_dir, 'name.bam'),
+                                         snps,
+                                         os.path.join(tmp_dir, 'file')))
+    expected = hash_file(os.path.join(tmp_dir, 'file_SNP_COUNTS.txt'))
+
+    for reads, options in [('name.bam', ' --bam'), ('name.bam', ''),
+                           ('name.sam', '')]:
+        prefix = os.path.join(tmp_dir, 'stdin')
+        run_countsnpase('--mode single --hash-choice{} --reads - --snps {} '
+                        '--prefix {}'.format(options, snps, prefix),
+                        pipe=os.path.join(tmp_dir, reads))
+        assert hash_file(prefix + '_SNP_COUNTS.txt') == expected
+        os.remove(prefix + '_SNP_COUNTS.txt')
+
+
+def test_contigs(tmp_dir):
+    """--contigs must only count the SNPs of the contigs listed."""
+    make_distant_mates(tmp_dir)
+    prefix = os.path.join(tmp_dir, 'contigs')
+    run_countsnpase('--mode single --contigs 2L,3L --reads {} --snps {} '
+                    '--prefix {}'.format(os.path.join(tmp_dir, 'name.bam'),
+                                         os.path.join(tmp_dir, 'snps.bed'),
+                                         prefix))
+    with open(prefix + '_SNP_COUNTS.txt') as fin:
+        fin.readline()
+        chroms = set([i.split('\t')[0] for i in fin])
+    assert chroms == set(['2L', '3L'])
+
+
+def test_lazy_contigs(tmp_dir):
+    """Contigs loaded on first use must match loading them all at once."""
+    from ASEr.counts import SNPCounts
+
+    bed_file = os.path.join(tmp_dir, 'snps.bed')
+    with open(bed_file, 'w') as fout:
+        for chrom, positions in [('chr2L', [10, 30, 20]), ('2R', [5, 15]),
+                                 ('3L', [7])]:
+            for pos in positions:
+                fout.write('{}\t{}\t{}\tA|G\n'.format(chrom, pos - 1, pos))
+
+    full = SNPCounts.from_bed(bed_file)
+    lazy = SNPCounts.from_bed(bed_file, ['2L'], lazy=True)
+    fixed = SNPCounts.from_bed(bed_file, ['2L'])
+    assert lazy.chroms == ['2L']
+    first = lazy.ordinal('2L', 20)
+
+    # Contigs outside the list are only counted when loaded lazily
+    assert fixed.ordinal('2R', 15) == -1
+    assert not fixed.overlaps('2R', 0, 20)
+    assert lazy.overlaps('2R', 0, 20)
+    assert lazy.ordinal('2R', 15) >= 0
+    assert lazy.ordinal('3L', 8) == -1
+    assert lazy.chroms == ['2L', '2R', '3L']
+    assert lazy.ordinal('2L', 20) == first
+    assert lazy.ordinal('X', 1) == -1
+    assert len(lazy) == len(full)
+
+    # Counts end up on the same SNPs as with everything loaded
+    for snps in [full, lazy]:
+        snps.add(snps.ordinal('2R', 5), 'A', '+')
+        snps.add(snps.ordinal('2L', 30), 'G', '-')
+        snps.add(snps.ordinal('3L', 7), 'A', '-')
+        snps.write(os.path.join(tmp_dir, 'counts{}.txt'.format(
+            len(snps.chroms))))
+    assert hash_file(os.path.join(tmp_dir, 'counts3.txt')) == \
+        hash_file(os.path.join(tmp_dir, 'counts4.txt'))
+
+
+def test_multi_shards(tmp_dir):
+    """Multi mode must give the same counts as single mode for any input."""
+    make_distant_mates(tmp_dir)
+    snps = os.path.join(tmp_dir, 'snps.bed')
+
+    run_countsnpase('--mode single --hash-choice --reads {} --snps {} '
+                    '--prefix {}'.format(os.path.join(tmp_dir, 'name.bam'),
+                                         snps,
+                                         os.path.join(tmp_dir, 'single')))
+    expected = hash_file(os.path.join(tmp_dir, 'single_SNP_COUNTS.txt'))
+
+    # Shards are cut at BGZF virtual offsets for the BAM and the bgzipped
+    # SAM, and at plain file offsets for the SAM
+    for reads in ['name.bam', 'name.sam', 'name.sam.gz']:
+        for threads in [1, 3]:
+            prefix = os.path.join(tmp_dir, 'multi')
+            run_countsnpase('--mode multi --jobs 5 --threads {} '
+                            '--hash-choice --reads {} --snps {} '
+                            '--prefix {}'.format(
+                                threads, os.path.join(tmp_dir, reads), snps,
+                                prefix))
+            assert hash_file(prefix + '_SNP_COUNTS.txt') == expected
+            os.remove(prefix + '_SNP_COUNTS.txt')
+
+
+def test_batch(tmp_dir):
+    """Batch mode and its matrix must match single mode runs of each file."""
+    samples = []
+    for seed, (name, fragments) in enumerate([('sampleA', 600),
+                                              ('sampleB', 400)]):
+        sample_dir = os.path.join(tmp_dir, name)
+        os.makedirs(sample_dir)
+        make_distant_mates(sample_dir, fragments, seed=seed)
+        samples.append((name, os.path.join(tmp_dir, name + '.bam')))
+        os.rename(os.path.join(sample_dir, 'name.bam'), samples[-1][1])
+    snps = os.path.join(tmp_dir, 'sampleA', 'snps.bed')
+
+    def read_counts(infile):
+        """Return chrom, position => (positive, negative) counts of a file."""
+        with open(infile) as fin:
+            fin.readline()
+            return dict([((i[0], i[1]), (i[2], i[3])) for i in
+                         [j.rstrip('\n').split('\t') for j in fin]])
+
+    # Every sample on its own
+    single = {}
+    for name, bam in samples:
+        prefix = os.path.join(tmp_dir, 'single_' + name)
+        run_countsnpase('--mode single --hash-choice --reads {} --snps {} '
+                        '--prefix {}'.format(bam, snps, prefix))
+        single[name] = prefix + '_SNP_COUNTS.txt'
+
+    reads = ' '.join([i[1] for i in samples])
+    for threads in [1, 2]:
+        prefix = os.path.join(tmp_dir, 'batch{}'.format(threads))
+        run_countsnpase('--mode batch --threads {} --hash-choice --reads {} '
+                        '--snps {} --prefix {}'.format(threads, reads, snps,
+                                                       prefix))
+        for name, _ in samples:
+            assert hash_file(prefix + '_' + name + '_SNP_COUNTS.txt') == \
+                hash_file(single[name])
+
+        run_countsnpase('--mode batch --matrix --threads {} --hash-choice '
+                        '--reads {} --snps {} --prefix {}'.format(
+                            threads, reads, snps, prefix))
+        with open(prefix + '_SNP_MATRIX.txt') as fin:
+            header = fin.readline().rstrip('\n').split('\t')
+            rows   = [i.rstrip('\n').split('\t') for i in fin]
+        assert header == ['CHR', 'POSITION',
+                          'sampleA_POS_A|C|G|T', 'sampleA_NEG_A|C|G|T',
+                          'sampleB_POS_A|C|G|T', 'sampleB_NEG_A|C|G|T']
+        for column, (name, _) in enumerate(samples):
+            counts = read_counts(single[name])
+            matrix = dict([((i[0], i[1]), (i[2+2*column], i[3+2*column]))
+                           for i in rows])
+            assert set(counts) <= set(matrix)
+            for snp, row in matrix.items():
+                assert row == counts.get(snp, ('0|0|0|0', '0|0|0|0'))
+        # Rows are in the same order as in a SNP_COUNTS file
+        with open(single['sampleA']) as fin:
+            fin.readline()
+            order = [tuple(i.split('\t')[:2]) for i in fin]
+        assert [tuple(i[:2]) for i in rows if tuple(i[:2]) in
+                set(order)] == order
+
+
+def test_metrics(tmp_dir):
+    """The multi mode metrics must add up the reads and counters of jobs."""
+    import pysam
+    from ASEr.metrics import read_metrics
+
+    make_distant_mates(tmp_dir, secondary=True)
+    bam = os.path.join(tmp_dir, 'name.bam')
+    with pysam.AlignmentFile(bam) as fin:
+        reads = sum([1 for _ in fin])
+
+    metrics = {}
+    for name, mode in [('single', '--mode single'),
+                       ('multi', '--mode multi --jobs 5 --threads 2')]:
+        prefix = os.path.join(tmp_dir, name)
+        run_countsnpase('{} --metrics --hash-choice --reads {} --snps {} '
+                        '--prefix {}'.format(mode, bam,
+                                             os.path.join(tmp_dir, 'snps.bed'),
+                                             prefix))
+        metrics[name] = read_metrics(prefix + '_metrics.json')
+
+    assert metrics['single']['reads'] == reads
+    assert metrics['multi']['reads'] == reads
+
+    # Every job of multi mode counts its own shard, the first entry is the
+    # process that started them
+    workers = metrics['multi']['workers'][1:]
+    assert metrics['multi']['workers'][0]['reads'] == 0
+    assert len(workers) > 1
+    assert sum([i['reads'] for i in workers]) == reads
+    counters = metrics['multi']['counters']
+    for key, value in counters.items():
+        assert sum([i['counters'].get(key, 0) for i in workers]) == value
+    assert counters == metrics['single']['counters']
+    assert counters['snp_count'] > 0
+
+
+def test_unseeded_choice(tmp_dir):
+    """Without a seed every fragment must still add exactly one read."""
+    make_distant_mates(tmp_dir, secondary=True)
+
+    # Every read of the 600 pairs overlaps a SNP
+    for name, options in [('single', '--mode single'),
+                          ('multi', '--mode multi --jobs 5 --threads 3'),
+                          ('region', '--mode region --jobs 5 --threads 3')]:
+        bam = 'coord.bam' if name == 'region' else 'name.bam'
+        run_countsnpase('{} --reads {} --snps {} --prefix {}'.format(
+            options, os.path.join(tmp_dir, bam),
+            os.path.join(tmp_dir, 'snps.bed'), os.path.join(tmp_dir, name)))
+        with open(os.path.join(tmp_dir, name + '_SNP_COUNTS.txt')) as fin:
+            fin.readline()
+            assert sum([int(i.rstrip().split('\t')[-1]) for i in fin]) == 600
+
+
+def test_multi_io_threads(tmp_dir):
+    """Multi mode must only decompress in threads when reading a BAM."""
+    make_distant_mates(tmp_dir)
+
+    outfiles = []
+    for name, options in [('single', '--mode single --io-threads 1'),
+                          ('multi', '--mode multi --jobs 4 --threads 2 '
+                                    '--io-threads 3')]:
+        run_countsnpase(
+            '{options} --hash-choice --reads {bam} --snps {snps} '
+            '--prefix {prefix}'.format(
+                options=options, bam=os.path.join(tmp_dir, 'name.bam'),
+                snps=os.path.join(tmp_dir, 'snps.bed'),
+                prefix=os.path.join(tmp_dir, name)))
+        outfiles.append(os.path.join(tmp_dir, name + '_SNP_COUNTS.txt'))
+    assert hash_file(outfiles[0]) == hash_file(outfiles[1])
+
+    # The threaded SAM reader reads ahead, so shard offsets would be wrong
+    retcode, stdout, stderr = run.cmd(
+        'python {root}/bin/CountSNPASE.py --mode multi --jobs 4 '
+        '--io-threads 3 --reads {sam} --snps {snps} --prefix {prefix}'.format(
+            root=ROOT_DIR, sam=os.path.join(tmp_dir, 'name.sam'),
+            snps=os.path.join(tmp_dir, 'snps.bed'),
+            prefix=os.path.join(tmp_dir, 'sam')))
+    assert retcode != 0
+    assert 'io-threads' in stderr
+    assert not os.path.isfile(os.path.join(tmp_dir, 'sam_SNP_COUNTS.txt'))
+
+
+################
+#  Gene Level  #
+################
+
+
+def run_getgenease(options):
+    """Run GetGeneASE.py with options, raise an Exception if it fails."""
+    command = 'python {}/bin/GetGeneASE.py {}'.format(ROOT_DIR, options)
+    retcode, stdout, stderr = run.cmd(command)
+    if not retcode == 0:
+        sys.stderr.write('CODE: {}\nSTDOUT:\n{}\nSTDERR:\n{}\n'.format(
+            retcode, stdout, stderr))
+        raise Exception('GetGeneASE.py {} failed'.format(options))
+
+
+def test_getgenease_threads(tmp_dir):
+    """GetGeneASE must give the same output for any number of processes."""
+    count_file = make_gene_data(tmp_dir)[0]
+
+    for stranded in ['', ' --stranded']:
+        outfiles = []
+        for threads in [1, 3]:
+            outfile = os.path.join(tmp_dir, 'genes{}.tsv'.format(threads))
+            run_getgenease(
+                '-c {} -p {} -g {} -o {} -w -m 2 --threads {}{}'.format(
+                    count_file, os.path.join(tmp_dir, 'phased.bed'),
+                    os.path.join(tmp_dir, 'ref.gtf'), outfile, threads,
+                    stranded))
+            outfiles.append(outfile)
+        assert hash_file(outfiles[0]) == hash_file(outfiles[1])
+        assert hash_file(outfiles[0] + '.snps.txt') == \
+            hash_file(outfiles[1] + '.snps.txt')
+
+
+def test_getgenease_matrix(tmp_dir):
+    """Every --matrix column must match a GetGeneASE run of its sample."""
+    count_files = make_gene_data(tmp_dir)
+    reference   = '-p {} -g {} -m 2'.format(
+        os.path.join(tmp_dir, 'phased.bed'), os.path.join(tmp_dir, 'ref.gtf'))
+
+    def read_table(infile):
+        """Return the rows of a table, split, header included."""
+        with open(infile) as fin:
+            return [i.rstrip('\n').split('\t') for i in fin]
+
+    for stranded in ['', ' --stranded']:
+        matrix = os.path.join(tmp_dir, 'matrix.tsv')
+        run_getgenease('-c {} {} -o {} --matrix --threads 2{}'.format(
+            ' '.join(count_files), reference, matrix, stranded))
+        tables = dict([(i, read_table(matrix + '.' + i + '.txt')) for i in
+                       ['ref', 'alt', 'n_snps', 'ref_biased', 'alt_biased']])
+        spans  = read_table(matrix)
+
+        for column, count_file in enumerate(count_files, 1):
+            outfile = os.path.join(tmp_dir, 'sample.tsv')
+            run_getgenease('-c {} {} -o {}{}'.format(count_file, reference,
+                                                     outfile, stranded))
+            sample = read_table(outfile)
+            assert [i[:4] for i in sample] == spans
+            for key, table in tables.items():
+                assert table[0][column] == 'sample{}'.format(column)
+                assert [i[0] for i in table] == [i[0] for i in sample]
+            for i, row in enumerate(sample[1:], 1):
+                assert tables['ref'][i][column] == row[4]
+                assert tables['alt'][i][column] == row[5]
+                assert tables['ref_biased'][i][column] == row[7]
+                assert tables['alt_biased'][i][column] == row[8]
+                # n_snps has a number where a feature without counts has NA
+                if row[6] != 'NA':
+                    assert tables['n_snps'][i][column] == row[6]
+
+
+#################
+#  Count Files  #
+#################
+
+
+def test_save_cache(tmp_dir):
+    """A cache of the same source must be kept, a stale one replaced."""
+    import numpy as np
+    from ASEr.cache import load_cache, save_cache
+
+    source    = os.path.join(tmp_dir, 'source.txt')
+    cache_dir = os.path.join(tmp_dir, 'source.txt.cache')
+    with open(source, 'w') as fout:
+        fout.write('first\n')
+
+    save_cache(cache_dir, source, 1, {'run': 1}, {'a': np.arange(3)})
+    save_cache(cache_dir, source, 1, {'run': 2}, {'a': np.arange(3)})
+    info, arrays = load_cache(cache_dir, source, 1)
+    assert info['run'] == 1
+    assert arrays['a'].tolist() == [0, 1, 2]
+
+    with open(source, 'w') as fout:
+        fout.write('second\n')
+    assert load_cache(cache_dir, source, 1) is None
+    save_cache(cache_dir, source, 1, {'run': 3}, {'a': np.arange(4)})
+    info, arrays = load_cache(cache_dir, source, 1)
+    assert info['run'] == 3
+    assert arrays['a'].tolist() == [0, 1, 2, 3]
+    del arrays
+    assert [i for i in os.listdir(tmp_dir) if i.startswith('.cache')] == []
+
+
+def test_annotation_cache(tmp_dir):
+    """A cached annotation must match a fresh parse and survive a touch."""
+    import numpy as np
+    from ASEr.annotation import load_annotation, _parse_gff
+
+    make_gene_data(tmp_dir)
+    gff_file  = os.path.join(tmp_dir, 'ref.gtf')
+    index_dir = gff_file + '.exon.gene_id.annidx'
+    fresh     = _parse_gff(gff_file, 'exon', 'gene_id')
+
+    load_annotation(gff_file)
+    arrays = [os.path.join(index_dir, i) for i in os.listdir(index_dir)
+              if i.endswith('.npy')]
+    assert arrays
+    stats = dict([(i, os.stat(i)) for i in arrays])
+
+    # Touched but unchanged, the arrays must not be rewritten
+    os.utime(gff_file, (0, 0))
+    for load in range(2):
+        cached = load_annotation(gff_file)
+        assert cached.chroms == fresh.chroms
+        for attr in ['names', 'feature_ids', 'chrom_ids', 'strands',
+                     'starts', 'ends']:
+            array = getattr(cached, attr)
+            assert isinstance(array, np.memmap)
+            assert np.array_equal(array, getattr(fresh, attr))
+        del cached, array
+    for array, stat in stats.items():
+        assert os.stat(array).st_ino == stat.st_ino
+        assert os.stat(array).st_mtime == stat.st_mtime
+
+
+def test_snp_bed_header(tmp_dir):
+    """Header, track and browser lines of a SNP BED must be skipped."""
+    from ASEr.snps import snps_from_bed
+    from ASEr.snpindex import load_snp_index
+
+    bed_file = os.path.join(tmp_dir, 'snps.bed')
+    with open(bed_file, 'w') as fout:
+        fout.write('browser position 2L:1-1000\n'
+                   'track name=snps description="test SNPs"\n'
+                   '#chrom\tstart\tend\tname\n'
+                   'chrom\tstart\tend\tname\n'
+                   '2L\t99\t100\trs2\n'
+                   '2L\t9\t10\trs1\n'
+                   'X\t4\t5\trs3\n')
+
+    # Once parsing the BED, once from its cached index
+    for _ in range(2):
+        index = load_snp_index(bed_file)
+        assert index.chroms == ['2L', 'X']
+        assert index.positions.tolist() == [10, 100, 5]
+        assert snps_from_bed(bed_file) == frozenset(['rs1', 'rs2', 'rs3'])
+
+
+def test_merge_count_files(tmp_dir):
+    """Merging text and binary count files must match summing the counts."""
+    import numpy as np
+    from ASEr.counts import SNPCounts
+    from ASEr.counts import merge_count_files, read_count_file, is_binary
+
+    # Positions of several widths, so 'chr|pos' order is not numeric order
+    rand  = random.Random(0)
+    snps  = SNPCounts(dict([(chrom, rand.sample(range(1, 200000), 300))
+                            for chrom in ['2L', '2R', '10', 'X']]))
+    total = snps.empty_like()
+    parts = []
+    for i, ext in enumerate(['.txt', '.txt', '.npz']):
+        part = snps.empty_like()
+        for _ in range(500):
+            part.add(rand.randrange(len(part)), rand.choice('ACGTN'),
+                     rand.choice('+-'))
+        total.add_sparse(*part.sparse())
+        parts.append(os.path.join(tmp_dir, 'part{}{}'.format(i, ext)))
+        part.write(parts[-1], binary=ext == '.npz')
+    assert [is_binary(i) for i in parts] == [False, False, True]
+
+    expected = os.path.join(tmp_dir, 'expected.txt')
+    total.write(expected)
+
+    merged = os.path.join(tmp_dir, 'merged.txt')
+    merge_count_files(parts, merged)
+    assert hash_file(merged) == hash_file(expected)
+
+    merged = os.path.join(tmp_dir, 'merged.npz')
+    merge_count_files(parts, merged, binary=True)
+    assert is_binary(merged)
+    data = read_count_file(merged)
+    want = read_count_file(expected)
+    for column in ['chroms', 'chrom_ids', 'positions', 'counts']:
+        assert np.array_equal(data[column], want[column])
+
+
 if __name__ == "__main__":
-    test_countsnpase()
-    test_getgenease()
-    print("All tests successful!")
+    sys.exit(pytest.main(['-q', __file__]))